@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Check that the search backends return the same ordering as an exact pgvector scan.
+
+Stored show embeddings are used as query vectors, so no embedding API calls are made.
+The exact reference orders by `CosineDistance` on the plain `vector` column, which cannot use the HNSW index.
+
+Usage:
+    uv run python benchmark/search_backend_parity.py --queries 50 --top-k 20
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.append(str(Path(__file__).resolve().parent / ".." / "src"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+django.setup()
+
+from pgvector.django import CosineDistance  # noqa: E402
+
+from movies.models import MotnShow  # noqa: E402
+from movies.search_backends import BACKENDS, get_search_backend  # noqa: E402
+
+
+def exact_search_ids(q_vec, top_k):
+    qs = (
+        MotnShow.objects.exclude(embedding__isnull=True)
+        .annotate(distance=CosineDistance("embedding", q_vec))
+        .order_by("distance", "id")
+    )
+    return list(qs.values_list("id", "distance")[:top_k])
+
+
+def compare(expected, actual, distance_tolerance):
+    """
+    Return (recall, ordering_ok) of `actual` against the `expected` top-k.
+
+    Neighbours whose distances are within `distance_tolerance` of each other may swap places.
+    """
+    expected_ids = [show_id for show_id, _ in expected]
+    actual_ids = [show_id for show_id, _ in actual]
+    recall = len(set(expected_ids) & set(actual_ids)) / max(len(expected_ids), 1)
+
+    expected_distance = dict(expected)
+    ordering_ok = len(actual) == len(expected)
+    for (exp_id, exp_dist), (act_id, act_dist) in zip(expected, actual, strict=False):
+        if exp_id != act_id and abs(exp_dist - act_dist) > distance_tolerance:
+            ordering_ok = False
+        if act_id in expected_distance and abs(expected_distance[act_id] - act_dist) > distance_tolerance:
+            ordering_ok = False
+    return recall, ordering_ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare search backends against an exact pgvector scan")
+    parser.add_argument("--queries", type=int, default=50, help="Number of sampled show embeddings to query with")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument(
+        "--distance-tolerance",
+        type=float,
+        default=1e-3,
+        help="Allowed distance difference, halfvec/float16 storage rounds distances to ~3 decimals",
+    )
+    args = parser.parse_args()
+
+    queries = list(
+        MotnShow.objects.exclude(embedding__isnull=True)
+        .order_by("?")
+        .values_list("embedding", flat=True)[: args.queries]
+    )
+    if not queries:
+        print("No shows with embeddings found.")
+        return 1
+
+    failed = False
+    for name in args.backends:
+        backend = get_search_backend(name)
+        backend.search_ids(queries[0], args.top_k)  # warm up, e.g. load the NumPy matrix
+
+        recalls, mismatches, elapsed = [], 0, 0.0
+        for q_vec in queries:
+            expected = exact_search_ids(q_vec, args.top_k)
+
+            start = time.perf_counter()
+            actual = backend.search_ids(q_vec, args.top_k)
+            elapsed += time.perf_counter() - start
+
+            recall, ordering_ok = compare(expected, actual, args.distance_tolerance)
+            recalls.append(recall)
+            mismatches += not ordering_ok
+
+        mean_recall = sum(recalls) / len(recalls)
+        print(
+            f"{name:>10}: recall@{args.top_k}={mean_recall:.4f} "
+            f"ordering mismatches={mismatches}/{len(queries)} "
+            f"avg latency={elapsed / len(queries) * 1000:.1f} ms"
+        )
+        # Only the exact backend must match exactly, HNSW is approximate by design
+        if name == "numpy" and mismatches:
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
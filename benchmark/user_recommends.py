@@ -14,7 +14,7 @@ django.setup()
 
 from misc.utils.embedding import calculate_user_embedding  # noqa: E402
 from movies.models import UserViewInteraction  # noqa: E402
-from movies.search import search_shows  # noqa: E402
+from movies.search import search_shows, search_shows_many  # noqa: E402
 
 # MLflow setup
 mlflow.set_tracking_uri("sqlite:///mlflow.db")
@@ -42,6 +42,10 @@ def mrr(outputs, expectations) -> float:
         return 0.0
 
 
+# Result IDs of search_shows_many() keyed by tuple(user_embedding), filled before evaluating
+_precomputed: dict[tuple, list[int]] = {}
+
+
 def predict_fn(user_embedding_context):
     """
     Receives user_embedding_context.
@@ -69,6 +73,11 @@ def predict_fn(user_embedding_context):
         batch = [user_embedding_context]
 
     for user_embedding in batch:
+        key = tuple(user_embedding)
+        if key in _precomputed:
+            results.append(_precomputed[key])
+            continue
+
         # We search with a neutral query to rely on user embedding
         # 'recommend' or empty string could be used.
         # The user requested 'relevant recommendations', often implies 'what should I watch?'
@@ -189,6 +198,18 @@ def run_evaluation():
         print("No data found. Exiting.")
         return
 
+    # Search all users in one batch, predict_fn then only looks up the results
+    embeddings = [row["inputs"]["user_embedding_context"] for row in data]
+    batch_results = search_shows_many(
+        ["recommend shows"] * len(embeddings),
+        top_k=50,
+        alpha=0.2,
+        user_embeddings=embeddings,
+        projection=True,
+    )
+    for user_embedding, shows in zip(embeddings, batch_results, strict=True):
+        _precomputed[tuple(user_embedding)] = [s.id for s in shows]
+
     # Pass list of dicts directly to mlflow.genai.evaluate
 
     with mlflow.start_run(run_name="leave_one_out_eval"):
@@ -17,6 +17,10 @@ env = environ.Env(
     EMAIL_USE_TLS=(bool, True),
     EMAIL_HOST_USER=(str, ""),
     EMAIL_HOST_PASSWORD=(str, ""),
+    SEARCH_BACKEND=(str, "pgvector"),
+    SEARCH_MODE=(str, "vector"),
+    LOCAL_EMBEDDING_ONNX_FILE=(str, None),
+    OPENAI_BASE_URL=(str, None),
 )
 
 # Resolves to the src dir
@@ -173,3 +177,117 @@ else:
 
 OPENAI_EMBEDDING_MODEL = "text-embedding-3-large"
 OPENAI_EMBEDDING_DIM = 3072
+# Another OpenAI compatible endpoint, e.g. a local stand-in server, None for the OpenAI API
+OPENAI_BASE_URL = env("OPENAI_BASE_URL") or None
+
+# Query embedding cache: in-process LRU in front of the QueryEmbedding table
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_CACHE_TTL = 60 * 60 * 24 * 30  # seconds since last use
+QUERY_EMBEDDING_CACHE_MAX_ROWS = 100_000
+
+# HNSW index on `embedding::halfvec`, plain `vector` indexes are limited to 2000 dimensions
+VECTOR_INDEX_HNSW_M = 16
+VECTOR_INDEX_HNSW_EF_CONSTRUCTION = 64
+# Candidate list size per query, raised to top_k when more results are requested (pgvector caps it at 1000)
+VECTOR_SEARCH_HNSW_EF_SEARCH = 100
+# Keep scanning the index when filters remove candidates (pgvector >= 0.8), None to disable
+VECTOR_SEARCH_HNSW_ITERATIVE_SCAN = "strict_order"
+
+# Default search mode: "vector", "matryoshka", "binary" or "local", see movies.search_backends
+SEARCH_MODE = env("SEARCH_MODE")
+# Two-stage modes shortlist `top_k * SEARCH_CANDIDATE_MULTIPLIER` candidates on a compact column and rerank them
+# with the full vector: a renormalised prefix (`MotnShow.embedding_short`) or the sign bits (`embedding_bit`)
+EMBEDDING_SHORT_DIM = 512
+SEARCH_CANDIDATE_MULTIPLIER = 10
+
+# Local CPU encoder for the "local" search mode, its vectors are stored natively in `MotnShow.embedding_local`
+LOCAL_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+LOCAL_EMBEDDING_DIM = 384
+# ONNX file of the model repository to run with onnxruntime instead of torch, e.g. "onnx/model_qint8_avx512.onnx"
+LOCAL_EMBEDDING_ONNX_FILE = env("LOCAL_EMBEDDING_ONNX_FILE")
+
+# Multi-interest profiles: a user's interactions are clustered into up to TASTE_INTEREST_CLUSTERS centroids
+# (at least TASTE_INTEREST_MIN_ITEMS interactions each), personalised searches then run once per centroid
+SEARCH_MULTI_INTEREST = False
+TASTE_INTEREST_CLUSTERS = 3
+TASTE_INTEREST_MIN_ITEMS = 5
+# Taste profiles are updated incrementally in float4, every TASTE_PROFILE_REBUILD_EVERY updates a profile is
+# recomputed from all interactions so rounding errors do not accumulate
+TASTE_PROFILE_REBUILD_EVERY = 100
+
+# Shows stored per user in UserRecommendation, the refresh_recommendations command recomputes them
+# for RECOMMENDATIONS_CHUNK_SIZE users per task
+RECOMMENDATIONS_TOP_K = 50
+RECOMMENDATIONS_CHUNK_SIZE = 500
+# Rating changes queue a recommendation refresh, a background worker runs it RECOMMENDATIONS_REFRESH_DEBOUNCE
+# seconds after the last change of a burst, but at most RECOMMENDATIONS_REFRESH_MAX_DELAY seconds after the first
+RECOMMENDATIONS_REFRESH_DEBOUNCE = 5
+RECOMMENDATIONS_REFRESH_MAX_DELAY = 60
+RECOMMENDATIONS_REFRESH_POLL_INTERVAL = 1
+# Seconds after which a job claimed by a worker that died is picked up again
+RECOMMENDATIONS_REFRESH_LEASE = 300
+
+# Concurrent query embeddings are coalesced: texts submitted within EMBED_DISPATCH_MAX_WAIT_MS of the first one
+# are sent in one request (at most EMBED_DISPATCH_MAX_BATCH texts, EMBED_DISPATCH_MAX_CONCURRENT requests at a time)
+EMBED_DISPATCH_MAX_WAIT_MS = 5
+EMBED_DISPATCH_MAX_BATCH = 256
+EMBED_DISPATCH_MAX_CONCURRENT = 4
+
+# Threads per process for running independent search stages concurrently
+SEARCH_WORKER_THREADS = 8
+
+# UserQueryLog rows are written in batches by a background thread, rows are dropped when the queue is full
+QUERY_LOG_BATCH_SIZE = 100
+QUERY_LOG_FLUSH_INTERVAL_MS = 1000
+QUERY_LOG_MAX_QUEUE = 10_000
+
+# Vector search backend: "pgvector" (HNSW index in Postgres) or "numpy" (in-process matrix, see movies.search_backends)
+SEARCH_BACKEND = env("SEARCH_BACKEND")
+# float16 halves the memory, but NumPy has no BLAS kernel for it so the product itself is slower
+SEARCH_NUMPY_DTYPE = "float32"
+# Seconds between checks whether the stored embeddings changed and the matrix must be reloaded
+SEARCH_NUMPY_REFRESH_INTERVAL = 60
+
+# Hybrid search: a full-text leg over `MotnShow.search_document` fused with the vector leg by reciprocal rank fusion
+SEARCH_HYBRID = False
+SEARCH_TEXT_CONFIG = "english"
+# Results taken from each leg before fusing (at least top_k)
+SEARCH_HYBRID_CANDIDATES = 50
+# RRF score is sum(1 / (k + rank)), a larger k flattens the advantage of the first ranks
+SEARCH_HYBRID_RRF_K = 60
+
+# Latency budget of one search: the query embedding may take SEARCH_EMBED_BUDGET_SHARE of it, the vector search
+# the rest. When a stage fails or overruns, the search degrades to the embedding of a near-identical cached query
+# (at least SEARCH_FALLBACK_MIN_SIMILARITY trigram similarity), full-text results or the stored recommendations
+SEARCH_DEADLINE_MS = 2500
+SEARCH_EMBED_BUDGET_SHARE = 0.6
+SEARCH_FALLBACK_MIN_SIMILARITY = 0.6
+# Time the fallbacks get when the budget is already spent
+SEARCH_FALLBACK_BUDGET_MS = 500
+# Query embedding requests fail fast for EMBED_CIRCUIT_RESET_TIMEOUT seconds after EMBED_CIRCUIT_FAILURE_THRESHOLD
+# consecutive failures (errors or requests slower than EMBED_CIRCUIT_SLOW_CALL_MS)
+EMBED_CIRCUIT_FAILURE_THRESHOLD = 5
+EMBED_CIRCUIT_RESET_TIMEOUT = 30
+EMBED_CIRCUIT_SLOW_CALL_MS = 3000
+# Seconds before an OpenAI request is abandoned
+OPENAI_TIMEOUT = 10
+
+# build_embeddings packs up to EMBED_BUILD_MAX_TOKENS tokens (the API allows 300k) and EMBED_BUILD_MAX_ITEMS texts
+# into a request and keeps EMBED_BUILD_CONCURRENCY requests in flight, a failed request is retried up to
+# EMBED_BUILD_MAX_RETRIES times and abandoned after EMBED_BUILD_TIMEOUT seconds
+EMBED_BUILD_MAX_TOKENS = 250_000
+EMBED_BUILD_MAX_ITEMS = 2048
+EMBED_BUILD_CONCURRENCY = 8
+EMBED_BUILD_MAX_RETRIES = 8
+EMBED_BUILD_TIMEOUT = 120
+# build_embeddings workers claim ranges of EMBED_BUILD_RANGE_SIZE shows and checkpoint every EMBED_BUILD_PAGE_SIZE
+EMBED_BUILD_RANGE_SIZE = 20_000
+EMBED_BUILD_PAGE_SIZE = 5_000
+# build_embeddings --backend openai-batch submits a Batch API job per range (the API takes 50k requests per job)
+# and checks its status every EMBED_BATCH_POLL_INTERVAL seconds
+EMBED_BATCH_RANGE_SIZE = 50_000
+EMBED_BATCH_POLL_INTERVAL = 30
+# Vectors are also stored on disk by model and text hash, shared by the databases of all environments and branches
+EMBEDDING_STORE_DIR = BASE_DIR / "data" / "embeddings"
+# Default directory of export_catalog / import_catalog snapshots
+CATALOG_SNAPSHOT_DIR = BASE_DIR / "data" / "snapshots" / "catalog"
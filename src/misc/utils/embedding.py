@@ -1,12 +1,15 @@
+import hashlib
+
 import numpy as np
 
 from movies.models import UserViewInteraction
+from movies.taste_profile import fetch_interaction_embeddings, get_taste_vector, interaction_weight, interaction_weights
 
 
-def calculate_user_embedding(interactions_data):
+def calculate_user_embedding(interactions_data, field: str = "embedding"):
     """
     interactions_data: list of objects/dicts with:
-       - .show.embedding (or ['show']['embedding'])
+       - .show.embedding (or ['show']['embedding']), or the vector field named by `field`
        - .rating         (or ['rating'])
     """
     if not interactions_data:
@@ -20,25 +23,16 @@ def calculate_user_embedding(interactions_data):
         if isinstance(inter, dict):
             # For dict, we assume structure like {'show': {'embedding': ...}, 'rating': ...}
             rating = inter.get("rating")
-            show_emb = inter.get("show", {}).get("embedding")
+            show_emb = inter.get("show", {}).get(field)
         else:
             rating = inter.rating
-            show_emb = inter.show.embedding
+            show_emb = getattr(inter.show, field)
 
         if show_emb is None:
             continue
 
         emb = np.array(show_emb, dtype=float)
-        
-        # Define a simple weight:
-        if rating == 2:  # way up
-            w = 3.0
-        elif rating == 1:  # up
-            w = 2.0
-        elif rating == 0:  # down
-            w = 0.2
-        else:
-            w = 1.0
+        w = interaction_weight(rating)
 
         embs.append(emb)
         weights.append(w)
@@ -59,15 +53,49 @@ def calculate_user_embedding(interactions_data):
     return user_vec.tolist()
 
 
-def get_user_embedding(user_id: int, min_items: int = 3):
-    interactions = UserViewInteraction.objects.filter(user_id=user_id, show__embedding__isnull=False).select_related(
-        "show"
-    )
+def get_user_embedding(user_id: int, min_items: int = 3, field: str = "embedding"):
+    # `field` selects the embedding space, e.g. "embedding_local" for the local encoder
+    user_id = getattr(user_id, "pk", user_id)
+    if field == "embedding":
+        # Maintained per interaction, a single row lookup
+        return get_taste_vector(user_id, min_items=min_items)
+
+    interactions = UserViewInteraction.objects.filter(
+        user_id=user_id, **{f"show__{field}__isnull": False}
+    ).select_related("show")
 
     if interactions.count() < min_items:
         return None  # not enough data – fall back to query-only
 
-    return calculate_user_embedding(interactions)
+    return calculate_user_embedding(interactions, field=field)
+
+
+def bulk_user_embeddings(
+    user_ids, min_items: int = 3, field: str = "embedding", batch_size: int = 500
+) -> dict[int, list[float] | None]:
+    """
+    Taste vectors of many users, computed from their interactions, for batch jobs.
+
+    Gives the same numbers as `calculate_user_embedding`, but the rows of `batch_size` users are fetched
+    with one query and decoded into one 2-D array, weights are looked up vectorised.
+    Users with fewer than `min_items` embedded interactions get None.
+    """
+    user_ids = [getattr(user_id, "pk", user_id) for user_id in user_ids]
+    result = dict.fromkeys(user_ids)
+    for start in range(0, len(user_ids), batch_size):
+        for user_id, ratings, embs in fetch_interaction_embeddings(user_ids[start : start + batch_size], field):
+            if len(ratings) < min_items:
+                continue
+            user_vec = np.average(embs, axis=0, weights=interaction_weights(ratings))
+            norm = np.linalg.norm(user_vec)
+            if norm != 0:
+                result[user_id] = (user_vec / norm).tolist()
+    return result
+
+
+def text_hash(text: str) -> str:
+    """Content hash of an embedded text, to detect texts that changed since they were embedded."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
 def combine_query_and_user(q_vec, u_vec, alpha: float = 0.5):
@@ -80,3 +108,23 @@ def combine_query_and_user(q_vec, u_vec, alpha: float = 0.5):
         return q_vec
     combo = combo / norm
     return combo.tolist()
+
+
+def truncate_embedding(vec, dim: int):
+    """
+    Matryoshka-style truncation: keep the first `dim` values and renormalise.
+
+    Matches the `MotnShow.embedding_short` generated column (`l2_normalize(subvector(embedding, 1, dim))`).
+    """
+    short = np.array(vec[:dim], dtype=float)
+    norm = np.linalg.norm(short)
+    if norm == 0:
+        return short.tolist()
+    return (short / norm).tolist()
+
+
+def binary_quantize(vec) -> str:
+    """
+    Sign quantisation as a bit string, matches pgvector's `binary_quantize` used for `MotnShow.embedding_bit`.
+    """
+    return "".join("1" if x > 0 else "0" for x in vec)
@@ -0,0 +1,133 @@
+"""
+Batch computation of `UserRecommendation` for many users, see the `refresh_recommendations` command.
+
+Instead of one distance scan per user, the taste vectors of a chunk of users are stacked into a matrix and
+multiplied with the normalised catalog matrix, which scores every show for every user at once. Watched shows
+are masked out and the top shows per row are picked with `argpartition`. With multi-interest profiles every
+centroid gets a row and a user's score for a show is the best score of their centroids, like the merged
+per-interest searches of `update_user_recommendations()`.
+
+The catalog is set with `set_catalog()` in the parent process before the worker processes are forked,
+so they share its memory instead of each loading a copy.
+"""
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import UserInterestCentroid, UserRecommendation, UserTasteProfile, UserViewInteraction
+from .search_backends import NumpySearchBackend, top_k_indices
+from .taste_profile import compute_interest_centroids, rebuild_taste_profiles
+
+# (ids, matrix): sorted show ids and their normalised float32 embeddings
+_catalog = None
+
+
+def load_catalog():
+    """Load all show embeddings as `(ids, matrix)`, rows normalised."""
+    return NumpySearchBackend(dtype="float32").snapshot()
+
+
+def set_catalog(catalog):
+    global _catalog
+    _catalog = catalog
+
+
+def user_vectors(user_ids, multi_interest: bool = False, min_items: int = 3):
+    """
+    `(owners, vectors)`: normalised float32 rows and the user each row belongs to, ordered by user.
+
+    One row per user (their taste vector), or one per interest centroid with `multi_interest`.
+    Users with fewer than `min_items` embedded interactions have no row.
+    """
+    user_ids = sorted(user_ids)
+    profiles = {profile.user_id: profile for profile in UserTasteProfile.objects.filter(user_id__in=user_ids)}
+    missing = [user_id for user_id in user_ids if user_id not in profiles]
+    if missing:
+        profiles.update((profile.user_id, profile) for profile in rebuild_taste_profiles(missing))
+
+    eligible = [
+        user_id
+        for user_id in user_ids
+        if profiles[user_id].item_count >= min_items and profiles[user_id].vector_sum is not None
+    ]
+    if multi_interest:
+        for user_id in eligible:
+            if profiles[user_id].centroids_stale:
+                compute_interest_centroids(user_id)
+        rows = list(
+            UserInterestCentroid.objects.filter(user_id__in=eligible)
+            .order_by("user_id")
+            .values_list("user_id", "vector")
+        )
+    else:
+        rows = [(user_id, profiles[user_id].vector_sum) for user_id in eligible]
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, settings.OPENAI_EMBEDDING_DIM), dtype=np.float32)
+    owners = np.fromiter((user_id for user_id, _ in rows), dtype=np.int64, count=len(rows))
+    vectors = np.asarray([vector for _, vector in rows], dtype=np.float32)
+
+    norms = np.linalg.norm(vectors, axis=1)
+    nonzero = norms > 0
+    return owners[nonzero], vectors[nonzero] / norms[nonzero, None]
+
+
+def recommend(user_ids, top_k: int | None = None, multi_interest: bool | None = None) -> dict[int, list[int]]:
+    """Recommended show ids of every given user, best first; users without taste vector get an empty list."""
+    top_k = top_k or settings.RECOMMENDATIONS_TOP_K
+    multi_interest = settings.SEARCH_MULTI_INTEREST if multi_interest is None else multi_interest
+    ids, matrix = _catalog if _catalog is not None else load_catalog()
+
+    result = {user_id: [] for user_id in user_ids}
+    owners, vectors = user_vectors(user_ids, multi_interest=multi_interest)
+    if not len(owners) or not len(ids):
+        return result
+
+    scores = vectors @ matrix.T
+    # Rows of the same user are adjacent: keep each show's best score over the user's interests
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    users = owners[starts]
+    if len(starts) < len(owners):
+        scores = np.maximum.reduceat(scores, starts, axis=0)
+
+    # Mask watched shows, (user, show) pairs are mapped to (row, column) of the score matrix
+    watched = np.array(
+        UserViewInteraction.objects.filter(user_id__in=users.tolist()).values_list("user_id", "show_id"),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    columns = np.minimum(np.searchsorted(ids, watched[:, 1]), len(ids) - 1)
+    loaded = ids[columns] == watched[:, 1]
+    scores[np.searchsorted(users, watched[loaded, 0]), columns[loaded]] = -np.inf
+
+    for user_id, row, top in zip(users.tolist(), scores, top_k_indices(scores, top_k), strict=True):
+        result[user_id] = ids[top[np.isfinite(row[top])]].tolist()
+    return result
+
+
+def save_recommendations(recommendations: dict[int, list[int]]):
+    """Store the recommendations, with one UPDATE for users that have a row and one INSERT for the others."""
+    now = timezone.now()
+    with transaction.atomic():
+        existing = dict(
+            UserRecommendation.objects.filter(user_id__in=list(recommendations)).values_list("user_id", "id")
+        )
+        # bulk_update() does not touch auto_now fields
+        updated = [
+            UserRecommendation(id=existing[user_id], user_id=user_id, recommended_shows=shows, updated_at=now)
+            for user_id, shows in recommendations.items()
+            if user_id in existing
+        ]
+        UserRecommendation.objects.bulk_update(updated, ["recommended_shows", "updated_at"])
+        UserRecommendation.objects.bulk_create(
+            UserRecommendation(user_id=user_id, recommended_shows=shows)
+            for user_id, shows in recommendations.items()
+            if user_id not in existing
+        )
+
+
+def refresh_chunk(user_ids, top_k: int | None = None) -> int:
+    """Recompute and store the recommendations of a chunk of users, returns the number of users."""
+    save_recommendations(recommend(user_ids, top_k=top_k))
+    return len(user_ids)
@@ -0,0 +1,93 @@
+"""
+Circuit breaker for calls to an external service, e.g. the embeddings API.
+
+After `failure_threshold` consecutive failures (exceptions, or calls slower than `slow_call_ms`) the circuit opens
+and calls fail immediately with `CircuitOpenError` for `reset_timeout` seconds, so searches fall back at once
+instead of waiting for a provider that is down. Then one trial call is let through, it closes the circuit
+again when it succeeds.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float, slow_call_ms: int | None = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call_ms / 1000 if slow_call_ms else None
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        """Whether a call may be made now, in the half-open state only a single trial call is allowed."""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit %s closed", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._state() != self.OPEN:
+                    logger.warning("Circuit %s opened after %s failures", self.name, self._failures)
+                self._opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn` through the breaker, raises `CircuitOpenError` without calling it while the circuit is open."""
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit {self.name} is open")
+
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+
+        if self.slow_call is not None and time.monotonic() - started > self.slow_call:
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
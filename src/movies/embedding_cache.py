@@ -0,0 +1,241 @@
+"""
+Two-tier cache for query embeddings: an in-process LRU in front of the `QueryEmbedding` table.
+
+Entries are keyed by (model, sha256 of the normalized text), so "Cyberpunk anime " and "cyberpunk  anime"
+share one embedding. Database rows expire `QUERY_EMBEDDING_CACHE_TTL` seconds after their last use and the
+table is trimmed to the `QUERY_EMBEDDING_CACHE_MAX_ROWS` most recently used rows.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from .models import QueryEmbedding
+
+logger = logging.getLogger(__name__)
+
+# Trim the table once per this many inserts instead of on every write
+EVICT_EVERY = 100
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def query_hash(text: str) -> str:
+    return hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+
+
+class QueryEmbeddingCache:
+    def __init__(self, maxsize: int | None = None, ttl: int | None = None, max_rows: int | None = None):
+        self.maxsize = settings.QUERY_EMBEDDING_CACHE_SIZE if maxsize is None else maxsize
+        self.ttl = settings.QUERY_EMBEDDING_CACHE_TTL if ttl is None else ttl
+        self.max_rows = settings.QUERY_EMBEDDING_CACHE_MAX_ROWS if max_rows is None else max_rows
+
+        self._lock = threading.Lock()
+        # float32 arrays, a list of 3072 Python floats takes ~8x the memory
+        self._memory: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self._inserts = 0
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "evicted": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _remember(self, key, embedding: np.ndarray):
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        key = (model, query_hash(text))
+
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return embedding
+
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        row = (
+            QueryEmbedding.objects.filter(model=model, text_hash=key[1], last_used_at__gte=cutoff)
+            .values_list("id", "embedding")
+            .first()
+        )
+        if row is None:
+            self._count("misses")
+            return None
+
+        row_id, embedding = row
+        QueryEmbedding.objects.filter(id=row_id).update(hits=F("hits") + 1, last_used_at=timezone.now())
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, embedding)
+        self._count("db_hits")
+        return embedding
+
+    def set(self, model: str, text: str, embedding):
+        key = (model, query_hash(text))
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, embedding)
+
+        try:
+            QueryEmbedding.objects.update_or_create(
+                model=model,
+                text_hash=key[1],
+                defaults={"text": normalize_query(text), "embedding": embedding, "last_used_at": timezone.now()},
+            )
+        except IntegrityError:
+            pass  # stored concurrently by another session
+
+        with self._lock:
+            self._inserts += 1
+            evict = self._inserts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def get_or_embed(self, model: str, text: str, embed_fn) -> np.ndarray:
+        """Return the cached embedding of `text`, or compute it with `embed_fn(text)` and store it."""
+        embedding = self.get(model, text)
+        if embedding is None:
+            embedding = embed_fn(text)
+            self.set(model, text, embedding)
+            embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding
+
+    def get_similar(self, model: str, text: str, min_similarity: float | None = None) -> np.ndarray | None:
+        """
+        Return the embedding of the most similar cached query (trigram similarity of the normalized texts).
+
+        A fallback for when `text` itself cannot be embedded, e.g. "cyberpunk anime series" for
+        "cyberpunk anime serie". Returns None when no cached query is at least `min_similarity` alike.
+        """
+        min_similarity = settings.SEARCH_FALLBACK_MIN_SIMILARITY if min_similarity is None else min_similarity
+        normalized = normalize_query(text)
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        row = (
+            QueryEmbedding.objects.filter(model=model, last_used_at__gte=cutoff, text__trigram_similar=normalized)
+            .annotate(similarity=TrigramSimilarity("text", normalized))
+            .filter(similarity__gte=min_similarity)
+            .order_by("-similarity")
+            .values_list("embedding", flat=True)
+            .first()
+        )
+        if row is None:
+            return None
+        return np.asarray(row, dtype=np.float32)
+
+    def get_many(self, model: str, texts: list[str]) -> dict[str, np.ndarray]:
+        """Return cached embeddings by text for the texts that have one, with one query for the database tier."""
+        found, keys = {}, {}
+        with self._lock:
+            for text in texts:
+                key = (model, query_hash(text))
+                embedding = self._memory.get(key)
+                if embedding is not None:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    found[text] = embedding
+                else:
+                    keys.setdefault(key[1], []).append(text)
+
+        if keys:
+            cutoff = timezone.now() - timedelta(seconds=self.ttl)
+            rows = QueryEmbedding.objects.filter(
+                model=model, text_hash__in=list(keys), last_used_at__gte=cutoff
+            ).values_list("id", "text_hash", "embedding")
+            hit_ids = []
+            for row_id, text_hash, embedding in rows:
+                embedding = np.asarray(embedding, dtype=np.float32)
+                self._remember((model, text_hash), embedding)
+                for text in keys.pop(text_hash):
+                    found[text] = embedding
+                hit_ids.append(row_id)
+                self._count("db_hits")
+            if hit_ids:
+                QueryEmbedding.objects.filter(id__in=hit_ids).update(hits=F("hits") + 1, last_used_at=timezone.now())
+
+        for _ in keys:
+            self._count("misses")
+        return found
+
+    def set_many(self, model: str, embeddings: dict[str, list]):
+        now = timezone.now()
+        rows = {}
+        for text, embedding in embeddings.items():
+            embedding = np.asarray(embedding, dtype=np.float32)
+            text_hash = query_hash(text)
+            self._remember((model, text_hash), embedding)
+            rows[text_hash] = QueryEmbedding(
+                model=model, text_hash=text_hash, text=normalize_query(text), embedding=embedding, last_used_at=now
+            )
+
+        QueryEmbedding.objects.bulk_create(
+            rows.values(),
+            update_conflicts=True,
+            unique_fields=["model", "text_hash"],
+            update_fields=["embedding", "last_used_at"],
+        )
+        self.evict()
+
+    def get_or_embed_many(self, model: str, texts: list[str], embed_many_fn) -> list[np.ndarray]:
+        """
+        Return embeddings for all `texts`, in order.
+
+        Texts without a cached embedding are computed together with one `embed_many_fn(texts)` call,
+        duplicates (also after normalization) are embedded once.
+        """
+        found = self.get_many(model, texts)
+
+        missing = {}
+        for text in texts:
+            if text not in found:
+                missing.setdefault(query_hash(text), text)
+        if missing:
+            missing_texts = list(missing.values())
+            computed = dict(zip(missing_texts, embed_many_fn(missing_texts), strict=True))
+            self.set_many(model, computed)
+            for text in texts:
+                if text not in found:
+                    found[text] = np.asarray(computed[missing[query_hash(text)]], dtype=np.float32)
+
+        return [found[text] for text in texts]
+
+    def evict(self) -> int:
+        """Delete expired rows and trim the table to `max_rows`, returns the number of deleted rows."""
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        deleted, _ = QueryEmbedding.objects.filter(last_used_at__lt=cutoff).delete()
+
+        # Everything used at or before the first row past the limit goes
+        overflow = list(
+            QueryEmbedding.objects.order_by("-last_used_at").values_list("last_used_at", flat=True)[
+                self.max_rows : self.max_rows + 1
+            ]
+        )
+        if overflow:
+            trimmed, _ = QueryEmbedding.objects.filter(last_used_at__lte=overflow[0]).delete()
+            deleted += trimmed
+
+        with self._lock:
+            self.stats["evicted"] += deleted
+        if deleted:
+            logger.info("Evicted %s query embeddings", deleted)
+        return deleted
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+query_embedding_cache = QueryEmbeddingCache()
@@ -0,0 +1,112 @@
+"""
+Micro-batching of concurrent query embedding requests.
+
+Every Streamlit session searches from its own thread. Instead of one embeddings request per search,
+`EmbeddingDispatcher` collects the texts submitted within `EMBED_DISPATCH_MAX_WAIT_MS` of each other and
+embeds them with one batched call, then hands each caller its own vector. Texts that are already
+being embedded (also after normalization) share the pending result instead of being sent again.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+
+from .circuit_breaker import CircuitOpenError
+from .embedding_cache import query_hash
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingDispatcher:
+    def __init__(
+        self,
+        embed_many_fn,
+        max_wait_ms: int | None = None,
+        max_batch: int | None = None,
+        max_concurrent: int | None = None,
+    ):
+        self.embed_many_fn = embed_many_fn
+        self.max_wait = (settings.EMBED_DISPATCH_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+        self.max_batch = max_batch or settings.EMBED_DISPATCH_MAX_BATCH
+        self.max_concurrent = max_concurrent or settings.EMBED_DISPATCH_MAX_CONCURRENT
+
+        self._queue = queue.SimpleQueue()
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+        self.stats = {"requests": 0, "deduplicated": 0, "batches": 0, "texts": 0}
+
+    def _ensure_started(self):
+        # Called with self._lock held
+        if self._thread is None:
+            # Batches are sent concurrently, a slow request does not hold up the texts arriving meanwhile
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="embed-dispatch")
+            self._thread = threading.Thread(target=self._run, name="embed-dispatcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """Queue `text` for the next batch and return a future of its embedding."""
+        key = query_hash(text)
+        with self._lock:
+            self.stats["requests"] += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.stats["deduplicated"] += 1
+                return future
+
+            future = Future()
+            self._in_flight[key] = future
+            self._ensure_started()
+        self._queue.put((key, text, future))
+        return future
+
+    def embed(self, text: str):
+        """Embed `text` as part of a batch, blocks until its embedding is available."""
+        return self.submit(text).result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+
+            # Wait a few milliseconds for concurrent searches to join the batch
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list[tuple[str, str, Future]]):
+        try:
+            embeddings = self.embed_many_fn([text for _, text, _ in batch])
+        except CircuitOpenError as exc:
+            # Every batch fails this way while the circuit is open, the searches fall back on their own
+            logger.debug("Not embedding a batch of %s queries: %s", len(batch), exc)
+            results = [(future, None, exc) for _, _, future in batch]
+        except Exception as exc:
+            logger.warning("Failed to embed a batch of %s queries", len(batch), exc_info=True)
+            results = [(future, None, exc) for _, _, future in batch]
+        else:
+            results = [(future, embedding, None) for (_, _, future), embedding in zip(batch, embeddings, strict=True)]
+
+        with self._lock:
+            for key, _, _ in batch:
+                self._in_flight.pop(key, None)
+            self.stats["batches"] += 1
+            self.stats["texts"] += len(batch)
+
+        for future, embedding, exc in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(embedding)
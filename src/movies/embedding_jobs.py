@@ -0,0 +1,525 @@
+"""
+Resumable embedding runs for `build_embeddings`.
+
+A run is planned as ranges of show ids (`EmbeddingJobRange`), which worker processes claim one at a time
+with `SELECT ... FOR UPDATE SKIP LOCKED`. A range is read in keyset pages (`id > done_id ORDER BY id`), so
+every page is an index range scan and rows are neither skipped nor repeated while the table changes.
+After every page the range's `done_id` is stored: a run that crashed continues with `--resume` after the
+last stored page instead of starting over.
+
+Before a backend is called, vectors of unchanged texts are taken from the on-disk store
+(`movies.embedding_store`), and every computed vector is added to it.
+
+With the `openai-batch` backend every range is embedded by one OpenAI Batch API job instead (half the price,
+no rate limits, results within 24 hours): its requests are written as JSONL and uploaded, the job is polled
+and its output file is streamed into `write_vectors()`, requests the API rejected are read from its error file.
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import BooleanField, ExpressionWrapper, Q
+from django.utils import timezone
+from openai import OpenAI
+
+from core.settings import env
+from misc.utils.embedding import text_hash
+
+from .embedding_scheduler import EmbeddingScheduler
+from .embedding_store import get_store
+from .local_encoder import local_encoder
+from .models import EmbeddingJobRange, MotnShow
+from .search_backends import HEAVY_FIELDS
+from .vector_writer import write_vectors
+
+logger = logging.getLogger(__name__)
+
+# Texts per local encoder call
+LOCAL_BATCH_SIZE = 256
+# Vectors of a Batch API output file stored per write
+BATCH_OUTPUT_WRITE_SIZE = 1000
+BATCH_PENDING_STATUSES = {"validating", "in_progress", "finalizing", "cancelling"}
+# Backends that embed whole ranges through `run_worker()`: one scheduler per worker, or a Batch API job per range
+OPENAI_BACKENDS = ("openai", "openai-batch")
+
+
+def backend_target(backend: str) -> tuple[str, str]:
+    """`(field, model)` a backend writes, the OpenAI vectors or the native-dimension local ones."""
+    if backend in OPENAI_BACKENDS:
+        return "embedding", settings.OPENAI_EMBEDDING_MODEL
+    return "embedding_local", local_encoder.model_name
+
+
+def job_name(backend: str) -> str:
+    name = ":".join(backend_target(backend))
+    # Batch API ranges are checkpointed differently (by batch_id), they must not be resumed by the other backend
+    return f"{name}:batch" if backend == "openai-batch" else name
+
+
+def candidates():
+    # The vectors themselves are not needed, only the fields of the embedding text and whether they are set
+    return (
+        MotnShow.objects.exclude(overview="")
+        .defer(*HEAVY_FIELDS)
+        .annotate(
+            has_embedding=ExpressionWrapper(Q(embedding__isnull=False), output_field=BooleanField()),
+            has_embedding_local=ExpressionWrapper(Q(embedding_local__isnull=False), output_field=BooleanField()),
+        )
+        .prefetch_related("genres")
+        .order_by("id")
+    )
+
+
+def plan_job(job: str, range_size: int, after_id: int | None = None, limit: int | None = None) -> int:
+    """Replace the ranges of `job` by new ones covering all candidate shows, returns the number of shows."""
+    ids = candidates().filter(id__gt=after_id or 0).values_list("id", flat=True)
+    if limit is not None:
+        ids = ids[:limit]
+    ids = list(ids)
+
+    ranges = [
+        EmbeddingJobRange(job=job, first_id=ids[start], last_id=ids[min(start + range_size, len(ids)) - 1])
+        for start in range(0, len(ids), range_size)
+    ]
+    with transaction.atomic():
+        EmbeddingJobRange.objects.filter(job=job).delete()
+        EmbeddingJobRange.objects.bulk_create(ranges)
+    return len(ids)
+
+
+def release_claims(job: str) -> int:
+    """Make the unfinished ranges of a crashed run claimable again, returns how many there are."""
+    return EmbeddingJobRange.objects.filter(job=job, completed_at__isnull=True).update(claimed_at=None)
+
+
+def claim_range(job: str) -> EmbeddingJobRange | None:
+    with transaction.atomic():
+        job_range = (
+            EmbeddingJobRange.objects.select_for_update(skip_locked=True)
+            .filter(job=job, claimed_at__isnull=True, completed_at__isnull=True)
+            .order_by("first_id")
+            .first()
+        )
+        if job_range is not None:
+            job_range.claimed_at = timezone.now()
+            job_range.save(update_fields=["claimed_at"])
+    return job_range
+
+
+def _store_vectors(field: str, model: str, batch: list, embeddings):
+    """Write the vectors of `(show, text, digest)` tuples to the database and the on-disk store."""
+    # One COPY and UPDATE per batch, updated_at lets the in-process search backend notice the new vectors
+    digests = [digest for _, _, digest in batch]
+    write_vectors(
+        MotnShow,
+        field,
+        [show.id for show, _, _ in batch],
+        embeddings,
+        **{f"{field}_hash": digests, f"{field}_model": [model] * len(batch)},
+    )
+    get_store(model).put(digests, embeddings)
+
+
+def embed_shows(backend: str, pending: list) -> int:
+    """Embed `(show, text, digest)` tuples with the local encoder and store them, returns how many were stored."""
+    if backend in OPENAI_BACKENDS:
+        raise ValueError(f"The {backend} backend embeds whole ranges, see run_worker()")
+    field, model = backend_target(backend)
+    for start in range(0, len(pending), LOCAL_BATCH_SIZE):
+        batch = pending[start : start + LOCAL_BATCH_SIZE]
+        # Same model and settings as the query side, see `movies.local_encoder`
+        _store_vectors(field, model, batch, local_encoder.encode([text for _, text, _ in batch]))
+    return len(pending)
+
+
+def _pages(job_range: EmbeddingJobRange, page_size: int):
+    """Keyset pages of the range's shows after its checkpoint."""
+    after = job_range.first_id - 1 if job_range.done_id is None else job_range.done_id
+    while page := list(candidates().filter(id__gt=after, id__lte=job_range.last_id)[:page_size]):
+        yield page
+        after = page[-1].id
+
+
+def _pending_shows(page: list, field: str, model: str, only_changed: bool) -> list:
+    """`(show, text, digest)` of the shows to embed."""
+    # The text is built in Python (genres included), so changes are detected by comparing its hash;
+    # a cleared vector counts as changed even though its hash is still stored
+    pending = []
+    for show in page:
+        text = show.embedding_text
+        digest = text_hash(text)
+        if (
+            not only_changed
+            or not getattr(show, f"has_{field}")
+            or getattr(show, f"{field}_hash") != digest
+            or getattr(show, f"{field}_model") != model
+        ):
+            pending.append((show, text, digest))
+    return pending
+
+
+def fill_from_store(field: str, model: str, pending: list) -> tuple[int, list]:
+    """Store the vectors of `(show, text, digest)` tuples found on disk, returns their number and the others."""
+    found, vectors = get_store(model).get([digest for _, _, digest in pending])
+    if not found:
+        return 0, pending
+    hits = [pending[position] for position in found]
+    write_vectors(
+        MotnShow,
+        field,
+        [show.id for show, _, _ in hits],
+        vectors,
+        **{f"{field}_hash": [digest for _, _, digest in hits], f"{field}_model": [model] * len(hits)},
+    )
+    found = set(found)
+    return len(hits), [item for position, item in enumerate(pending) if position not in found]
+
+
+def fill_store_from_database(backend: str, page_size: int) -> int:
+    """Add the vectors already in the database to the on-disk store, returns how many were added."""
+    field, model = backend_target(backend)
+    store = get_store(model)
+    rows = MotnShow.objects.filter(**{f"{field}_model": model, f"{field}__isnull": False}).exclude(
+        **{f"{field}_hash": ""}
+    )
+    added, after = 0, 0
+    while page := list(rows.filter(id__gt=after).order_by("id").values_list("id", f"{field}_hash", field)[:page_size]):
+        added += store.put([digest for _, digest, _ in page], [vector for _, _, vector in page])
+        after = page[-1][0]
+    return added
+
+
+def embed_range(
+    job_range: EmbeddingJobRange,
+    backend: str,
+    only_changed: bool,
+    page_size: int,
+    use_store: bool = True,
+) -> int:
+    """
+    Embed the shows of a claimed range page by page from its checkpoint with the local encoder, returns how many
+    were embedded. The OpenAI backends have their own paths, see `run_worker()`.
+    """
+    if backend in OPENAI_BACKENDS:
+        raise ValueError(f"The {backend} backend embeds whole ranges, see run_worker()")
+    field, model = backend_target(backend)
+    label = f"Range {job_range.first_id}-{job_range.last_id}"
+    embedded = 0
+    for page in _pages(job_range, page_size):
+        pending = _pending_shows(page, field, model, only_changed)
+        from_store = 0
+        if use_store and pending:
+            from_store, pending = fill_from_store(field, model, pending)
+        count = from_store + (embed_shows(backend, pending) if pending else 0)
+        embedded += count
+        job_range.done_id = page[-1].id
+        job_range.embedded += count
+        job_range.save(update_fields=["done_id", "embedded"])
+        logger.info(
+            "%s: embedded %s/%s (%s from the store) up to id %s", label, count, len(page), from_store, job_range.done_id
+        )
+
+    job_range.completed_at = timezone.now()
+    job_range.save(update_fields=["completed_at"])
+    return embedded
+
+
+async def _embed_range_with_scheduler(
+    scheduler: EmbeddingScheduler, job_range: EmbeddingJobRange, only_changed: bool, page_size: int, use_store: bool
+) -> int:
+    """
+    `embed_range()` with the OpenAI API, the texts of every page are submitted to the same scheduler.
+
+    Pages are read ahead while the scheduler has fewer batches than concurrent requests, so requests span page
+    boundaries. The checkpoint advances in page order, once all batches of a page are stored.
+    """
+    field, model = backend_target("openai")
+    label = f"Range {job_range.first_id}-{job_range.last_id}"
+    pages = _pages(job_range, page_size)
+    # The ORM is synchronous: pages are read and vectors stored one at a time in a worker thread
+    store = sync_to_async(_store_vectors, thread_sensitive=True)
+    save = sync_to_async(job_range.save, thread_sensitive=True)
+
+    def read_page():
+        page = next(pages, None)
+        if page is None:
+            return None
+        pending = _pending_shows(page, field, model, only_changed)
+        from_store = 0
+        if use_store and pending:
+            from_store, pending = fill_from_store(field, model, pending)
+        return page, pending, from_store
+
+    # `(page, from_store, stored ids, future of the failed indices)` in page order
+    in_flight = deque()
+    embedded = failed_total = 0
+    resume_after = job_range.done_id
+
+    async def checkpoint():
+        nonlocal embedded, failed_total
+        page, from_store, stored, done = in_flight.popleft()
+        # Raises when the scheduler stopped on an error no retry fixes, the range stays unfinished
+        failed = await done
+        if failed:
+            # Their hash is not stored, the next --only-changed run picks them up
+            logger.warning("%s: failed to embed %s titles", label, len(failed))
+            failed_total += len(failed)
+        count = from_store + len(stored)
+        embedded += count
+        job_range.done_id = page[-1].id
+        job_range.embedded += count
+        await save(update_fields=["done_id", "embedded"])
+        logger.info(
+            "%s: embedded %s/%s (%s from the store) up to id %s", label, count, len(page), from_store, job_range.done_id
+        )
+
+    while (item := await sync_to_async(read_page, thread_sensitive=True)()) is not None:
+        page, pending, from_store = item
+        stored = []
+
+        async def on_batch(indices, embeddings, pending=pending, stored=stored):
+            batch = [pending[index] for index in indices]
+            await store(field, model, batch, embeddings)
+            stored.extend(show.id for show, _, _ in batch)
+
+        in_flight.append((page, from_store, stored, scheduler.submit([text for _, text, _ in pending], on_batch)))
+        while in_flight and (in_flight[0][3].done() or scheduler.backlog >= scheduler.concurrency):
+            await checkpoint()
+    while in_flight:
+        await checkpoint()
+
+    if failed_total and not embedded:
+        # Nothing to keep, the next run embeds the range again
+        job_range.done_id = resume_after
+        await save(update_fields=["done_id"])
+        raise RuntimeError(f"All {failed_total} titles of {label} failed to embed")
+    job_range.completed_at = timezone.now()
+    await save(update_fields=["completed_at"])
+    return embedded
+
+
+async def _run_openai_worker(job: str, only_changed: bool, page_size: int, use_store: bool) -> int:
+    # One scheduler for all ranges of the worker, its rate limit state carries over between them
+    scheduler = EmbeddingScheduler()
+    claim = sync_to_async(claim_range, thread_sensitive=True)
+    embedded = 0
+    try:
+        while (job_range := await claim(job)) is not None:
+            embedded += await _embed_range_with_scheduler(scheduler, job_range, only_changed, page_size, use_store)
+    finally:
+        await scheduler.close()
+        # The connection of the thread that ran the queries
+        await sync_to_async(connections.close_all, thread_sensitive=True)()
+    logger.info("Embedding requests: %s", scheduler.stats)
+    return embedded
+
+
+def get_batch_client() -> OpenAI:
+    # Uploads and output files are large, the query timeout is too short for them
+    return OpenAI(
+        api_key=env("OPENAI_API_KEY"), base_url=settings.OPENAI_BASE_URL, timeout=settings.EMBED_BUILD_TIMEOUT
+    )
+
+
+def _write_batch_requests(
+    job_range: EmbeddingJobRange, only_changed: bool, page_size: int, path: Path, use_store: bool
+) -> tuple[int, int]:
+    """
+    Write a Batch API request per show to embed as JSONL.
+
+    Returns the number of requests and of the shows filled from the store instead.
+    """
+    field, model = backend_target("openai-batch")
+    count = from_store = 0
+    with path.open("w", encoding="utf-8") as fh:
+        for page in _pages(job_range, page_size):
+            pending = _pending_shows(page, field, model, only_changed)
+            if use_store and pending:
+                filled, pending = fill_from_store(field, model, pending)
+                from_store += filled
+            for show, text, digest in pending:
+                request = {
+                    # The digest of the submitted text is stored with the vector, even if the text changes meanwhile
+                    "custom_id": f"{show.id}:{digest}",
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    # base64 output is a quarter of the size of JSON floats
+                    "body": {"model": model, "input": text, "encoding_format": "base64"},
+                }
+                fh.write(json.dumps(request) + "\n")
+                count += 1
+    return count, from_store
+
+
+def _request_error(result: dict) -> str | None:
+    """Error message of a Batch API result line, None if the request succeeded."""
+    if result.get("error"):
+        return result["error"].get("message") or str(result["error"])
+    response = result.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code", 200) >= 400 or not body.get("data"):
+        return (body.get("error") or {}).get("message") or f"status {response.get('status_code')}"
+    return None
+
+
+def _read_batch_errors(client: OpenAI, file_id: str) -> dict[int, str]:
+    """Show ids and error messages of the failed requests in a Batch API error file."""
+    errors = {}
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line:
+                result = json.loads(line)
+                errors[int(result["custom_id"].split(":")[0])] = _request_error(result) or "unknown error"
+    return errors
+
+
+def _store_batch_output(client: OpenAI, file_id: str) -> tuple[int, dict[int, str]]:
+    """Stream a Batch API output file into the vector column, returns the number stored and the failed shows."""
+    field, model = backend_target("openai-batch")
+    ids, digests, vectors = [], [], []
+    stored, errors = 0, {}
+
+    def flush():
+        nonlocal stored
+        write_vectors(MotnShow, field, ids, vectors, **{f"{field}_hash": digests, f"{field}_model": [model] * len(ids)})
+        get_store(model).put(digests, vectors)
+        stored += len(ids)
+        ids.clear()
+        digests.clear()
+        vectors.clear()
+
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            show_id, digest = result["custom_id"].split(":")
+            if error := _request_error(result):
+                errors[int(show_id)] = error
+                continue
+
+            embedding = result["response"]["body"]["data"][0]["embedding"]
+            if isinstance(embedding, str):
+                embedding = np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+            ids.append(int(show_id))
+            digests.append(digest)
+            vectors.append(embedding)
+            if len(ids) == BATCH_OUTPUT_WRITE_SIZE:
+                flush()
+    if ids:
+        flush()
+    return stored, errors
+
+
+def embed_range_with_batch_api(
+    job_range: EmbeddingJobRange,
+    only_changed: bool,
+    page_size: int,
+    client: OpenAI | None = None,
+    poll_interval: float | None = None,
+    use_store: bool = True,
+) -> int:
+    """
+    Embed the shows of a claimed range with one Batch API job, returns how many were embedded.
+
+    The job id is stored on the range as soon as it is submitted: a resumed run waits for the same job
+    instead of submitting (and paying for) it again.
+    """
+    client = client or get_batch_client()
+    poll_interval = settings.EMBED_BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    label = f"Range {job_range.first_id}-{job_range.last_id}"
+
+    from_store = 0
+    if not job_range.batch_id:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "requests.jsonl"
+            count, from_store = _write_batch_requests(job_range, only_changed, page_size, path, use_store)
+            if from_store:
+                job_range.embedded += from_store
+                job_range.save(update_fields=["embedded"])
+                logger.info("%s: embedded %s from the store", label, from_store)
+            if not count:
+                job_range.done_id = job_range.last_id
+                job_range.completed_at = timezone.now()
+                job_range.save(update_fields=["done_id", "completed_at"])
+                return from_store
+            with path.open("rb") as fh:
+                input_file = client.files.create(file=fh, purpose="batch")
+
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h",
+            metadata={"job": job_range.job, "range": f"{job_range.first_id}-{job_range.last_id}"},
+        )
+        job_range.batch_id = batch.id
+        job_range.save(update_fields=["batch_id"])
+        logger.info("%s: submitted %s requests as batch %s", label, count, batch.id)
+
+    batch = client.batches.retrieve(job_range.batch_id)
+    while batch.status in BATCH_PENDING_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(job_range.batch_id)
+
+    if batch.status not in ("completed", "expired") or (batch.status == "expired" and not batch.output_file_id):
+        # Submitted again by the next run
+        job_range.batch_id = ""
+        job_range.save(update_fields=["batch_id"])
+        raise RuntimeError(f"Batch {batch.id} of {label} ended as {batch.status}: {batch.errors}")
+
+    # An expired job has the results that completed in time, the others are left for the next run
+    stored, errors = _store_batch_output(client, batch.output_file_id) if batch.output_file_id else (0, {})
+    # Requests rejected by the API are not in the output file but in the error file
+    if batch.error_file_id:
+        errors.update(_read_batch_errors(client, batch.error_file_id))
+    failed = max(len(errors), batch.request_counts.failed if batch.request_counts else 0)
+    if failed:
+        # Their hash is not stored, the next --only-changed run picks them up
+        show_ids = sorted(errors)
+        logger.warning(
+            "%s: %s requests of batch %s failed (%s), shows %s%s",
+            label,
+            failed,
+            batch.id,
+            next(iter(errors.values()), "no error file"),
+            ", ".join(map(str, show_ids[:20])),
+            " ..." if len(show_ids) > 20 else "",
+        )
+    if batch.status == "expired":
+        logger.warning("%s: batch %s expired, its remaining requests are left for the next run", label, batch.id)
+    if failed and not stored:
+        # Nothing to keep, submitted again by the next run
+        job_range.batch_id = ""
+        job_range.save(update_fields=["batch_id"])
+        raise RuntimeError(f"All {failed} requests of batch {batch.id} of {label} failed")
+
+    job_range.done_id = job_range.last_id
+    job_range.embedded += stored
+    job_range.completed_at = timezone.now()
+    job_range.save(update_fields=["done_id", "embedded", "completed_at"])
+    logger.info("%s: embedded %s from batch %s", label, stored, batch.id)
+    return from_store + stored
+
+
+def run_worker(job: str, backend: str, only_changed: bool, page_size: int, use_store: bool = True) -> int:
+    """Process ranges of `job` until none are left to claim, returns the number of embedded shows."""
+    if backend == "openai":
+        # One event loop and scheduler per worker
+        return asyncio.run(_run_openai_worker(job, only_changed, page_size, use_store))
+    embedded = 0
+    while (job_range := claim_range(job)) is not None:
+        if backend == "openai-batch":
+            embedded += embed_range_with_batch_api(job_range, only_changed, page_size, use_store=use_store)
+        else:
+            embedded += embed_range(job_range, backend, only_changed, page_size, use_store=use_store)
+    return embedded
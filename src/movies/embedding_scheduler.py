@@ -0,0 +1,315 @@
+"""
+Throughput-bound bulk embedding with the OpenAI API, used by `build_embeddings`.
+
+Texts are packed into requests by token count instead of a fixed number of items, staying under the API's
+tokens-per-request limit while filling every request. Several requests are kept in flight with asyncio.
+The `x-ratelimit-*` headers of every response tell how many tokens are left in the current window: requests
+wait for the window to reset instead of running into 429s, and a 429 pauses all requests for the time the API
+asks for, growing exponentially while they keep coming. A failed request is retried on its own, a rejected one
+is split to isolate the offending text. Any other error status (a wrong key, model or permission) fails every
+request alike: the scheduler stops and the callers awaiting its submissions get the exception.
+
+A scheduler is meant to live as long as its worker: `submit()` adds the texts of every page read from the
+database to the same queue, so requests of consecutive pages overlap and the rate limit state carries over.
+
+Token counts come from tiktoken when it is installed, otherwise from a conservative estimate.
+"""
+
+import asyncio
+import logging
+import math
+import random
+import re
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    BadRequestError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from core.settings import env
+
+logger = logging.getLogger(__name__)
+
+# Without tiktoken: English averages 4 characters per token, estimate high to stay under the limits
+CHARS_PER_TOKEN_ESTIMATE = 3
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str | None) -> float | None:
+    """Seconds of a rate limit reset header like "20ms", "1s" or "6m0s"."""
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def count_tokens(texts: list[str], model: str) -> list[int]:
+    try:
+        import tiktoken
+    except ImportError:
+        return [math.ceil(len(text) / CHARS_PER_TOKEN_ESTIMATE) + 1 for text in texts]
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+
+class Submission:
+    """Texts passed to one `EmbeddingScheduler.submit()` call, `done` resolves to the indices that failed."""
+
+    def __init__(self, texts: list[str], token_counts: list[int], on_batch):
+        self.texts = texts
+        self.token_counts = token_counts
+        self.on_batch = on_batch
+        self.failed = []
+        self.pending = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+    def batch_done(self):
+        self.pending -= 1
+        if self.pending == 0 and not self.done.done():
+            self.done.set_result(sorted(self.failed))
+
+
+@dataclass
+class Batch:
+    indices: list[int]
+    tokens: int
+    submission: Submission | None = None
+    attempts: int = 0
+
+
+def pack_batches(
+    token_counts: list[int], max_tokens: int, max_items: int, submission: Submission | None = None
+) -> list[Batch]:
+    """Consecutive texts packed into batches of at most `max_tokens` tokens and `max_items` texts."""
+    batches = []
+    indices, tokens = [], 0
+    for index, count in enumerate(token_counts):
+        if indices and (tokens + count > max_tokens or len(indices) == max_items):
+            batches.append(Batch(indices, tokens, submission))
+            indices, tokens = [], 0
+        indices.append(index)
+        tokens += count
+    if indices:
+        batches.append(Batch(indices, tokens, submission))
+    return batches
+
+
+class RateLimiter:
+    """Token budget of the current rate limit window, as last reported by the API, shared by all requests."""
+
+    def __init__(self):
+        self.remaining_tokens = None
+        self.tokens_reset_at = 0.0
+        self.remaining_requests = None
+        self.requests_reset_at = 0.0
+        self.paused_until = 0.0
+        self.consecutive_limited = 0
+
+    async def acquire(self, tokens: int):
+        while True:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if self.remaining_tokens is not None and tokens > self.remaining_tokens and now < self.tokens_reset_at:
+                wait = max(wait, self.tokens_reset_at - now)
+            if self.remaining_requests is not None and self.remaining_requests < 1 and now < self.requests_reset_at:
+                wait = max(wait, self.requests_reset_at - now)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        # Reserve the budget until the response reports the actual numbers
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+
+    def update(self, headers):
+        now = time.monotonic()
+        if (remaining := headers.get("x-ratelimit-remaining-tokens")) is not None:
+            self.remaining_tokens = int(remaining)
+            self.tokens_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+        if (remaining := headers.get("x-ratelimit-remaining-requests")) is not None:
+            self.remaining_requests = int(remaining)
+            self.requests_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-requests")) or 0)
+        self.consecutive_limited = 0
+
+    def limited(self, headers) -> float:
+        """Pause all requests after a 429, returns the pause in seconds."""
+        self.consecutive_limited += 1
+        retry_after = None
+        if headers is not None:
+            if (milliseconds := headers.get("retry-after-ms")) is not None:
+                retry_after = float(milliseconds) / 1000
+            elif (seconds := headers.get("retry-after")) is not None and seconds.replace(".", "", 1).isdigit():
+                retry_after = float(seconds)
+            else:
+                retry_after = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        backoff = min(2 ** (self.consecutive_limited - 1), 60) * (1 + random.random() / 4)
+        pause = max(retry_after or 0, backoff)
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        return pause
+
+
+class EmbeddingScheduler:
+    def __init__(
+        self,
+        model: str | None = None,
+        max_tokens: int | None = None,
+        max_items: int | None = None,
+        concurrency: int | None = None,
+        max_retries: int | None = None,
+        client: AsyncOpenAI | None = None,
+    ):
+        self.model = model or settings.OPENAI_EMBEDDING_MODEL
+        self.max_tokens = max_tokens or settings.EMBED_BUILD_MAX_TOKENS
+        self.max_items = max_items or settings.EMBED_BUILD_MAX_ITEMS
+        self.concurrency = concurrency or settings.EMBED_BUILD_CONCURRENCY
+        self.max_retries = settings.EMBED_BUILD_MAX_RETRIES if max_retries is None else max_retries
+        # Retries are ours, per batch and aware of the rate limit window
+        self.client = client or AsyncOpenAI(
+            api_key=env("OPENAI_API_KEY"),
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=settings.EMBED_BUILD_TIMEOUT,
+            max_retries=0,
+        )
+        self.limiter = RateLimiter()
+        self.stats = {"requests": 0, "tokens": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+        # Batches submitted and not done yet: queued, in flight or waiting to be retried
+        self.backlog = 0
+        # The error that stopped the scheduler, raised by every later `submit()`
+        self.error = None
+        self._queue = None
+        self._workers = []
+        self._submissions = set()
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._queue, self._workers = None, []
+
+    def submit(self, texts: list[str], on_batch) -> asyncio.Future:
+        """
+        Queue `texts`, awaiting `on_batch(indices, embeddings)` for every completed batch (in completion order).
+
+        Returns a future of the indices of the texts that could not be embedded.
+        """
+        if self.error is not None:
+            raise self.error
+        self.start()
+        submission = Submission(texts, count_tokens(texts, self.model), on_batch)
+        batches = pack_batches(submission.token_counts, self.max_tokens, self.max_items, submission)
+        if not batches:
+            submission.done.set_result([])
+        else:
+            self._submissions.add(submission)
+            submission.done.add_done_callback(lambda _: self._submissions.discard(submission))
+        submission.pending = len(batches)
+        self.backlog += len(batches)
+        for batch in batches:
+            self._queue.put_nowait(batch)
+        return submission.done
+
+    async def _worker(self):
+        while True:
+            batch = await self._queue.get()
+            submission = batch.submission
+            try:
+                for retry in await self._process(batch):
+                    submission.pending += 1
+                    self.backlog += 1
+                    self._queue.put_nowait(retry)
+            except APIStatusError:
+                # The scheduler is stopped, see `_abort()`
+                return
+            except Exception:
+                logger.exception("Failed to store a batch of %s embeddings", len(batch.indices))
+                submission.failed.extend(batch.indices)
+            finally:
+                self.backlog -= 1
+                submission.batch_done()
+
+    async def _process(self, batch: Batch) -> list[Batch]:
+        """Send one batch, returns the batches to retry."""
+        submission = batch.submission
+        await self.limiter.acquire(batch.tokens)
+        self.stats["requests"] += 1
+        try:
+            response = await self.client.embeddings.with_raw_response.create(
+                model=self.model, input=[submission.texts[index] for index in batch.indices]
+            )
+        except RateLimitError as exc:
+            self.stats["rate_limited"] += 1
+            pause = self.limiter.limited(exc.response.headers)
+            logger.info("Rate limited, pausing requests for %.1f s", pause)
+            return self._retry(batch)
+        except BadRequestError:
+            if len(batch.indices) == 1:
+                logger.warning("The embeddings API rejected text %s", batch.indices[0], exc_info=True)
+                self.stats["failed"] += 1
+                submission.failed.extend(batch.indices)
+                return []
+            # Isolate the rejected text(s), the other halves go through
+            middle = len(batch.indices) // 2
+            halves = (batch.indices[:middle], batch.indices[middle:])
+            return [Batch(half, sum(submission.token_counts[index] for index in half), submission) for half in halves]
+        except (APIConnectionError, APITimeoutError, InternalServerError):
+            logger.warning("Embeddings request failed (attempt %s)", batch.attempts + 1, exc_info=True)
+            await asyncio.sleep(min(2**batch.attempts, 60) * (1 + random.random() / 4))
+            return self._retry(batch)
+        except APIStatusError as exc:
+            self._abort(exc)
+            raise
+
+        self.limiter.update(response.headers)
+        embeddings = [item.embedding for item in response.parse().data]
+        self.stats["tokens"] += batch.tokens
+        await submission.on_batch(batch.indices, embeddings)
+        return []
+
+    def _abort(self, exc: APIStatusError):
+        """Stop on an error that no retry fixes: fail all open submissions and cancel the other workers."""
+        logger.error("Stopping, the embeddings API refused a request: %s", exc.message)
+        self.error = exc
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self.backlog -= 1
+        for submission in list(self._submissions):
+            if not submission.done.done():
+                submission.done.set_exception(exc)
+                # Logged above, not again for every submission nobody awaits any more
+                submission.done.exception()
+        current = asyncio.current_task()
+        for worker in self._workers:
+            if worker is not current:
+                worker.cancel()
+
+    def _retry(self, batch: Batch) -> list[Batch]:
+        batch.attempts += 1
+        if batch.attempts > self.max_retries:
+            logger.error("Giving up on a batch of %s texts after %s attempts", len(batch.indices), batch.attempts)
+            self.stats["failed"] += len(batch.indices)
+            batch.submission.failed.extend(batch.indices)
+            return []
+        self.stats["retries"] += 1
+        return [batch]
@@ -0,0 +1,170 @@
+"""
+On-disk embedding store shared by all databases of a checkout.
+
+Production, develop, local and every branch database embed the same catalog texts. Vectors are therefore also
+kept in `EMBEDDING_STORE_DIR` (`data/embeddings`, mounted into every docker compose service), addressed by the
+embedding model and the SHA-256 of the embedded text, and `build_embeddings` takes them from there before
+calling a backend: filling a new branch database costs no API calls.
+
+Every model has a directory of shards, raw float32 arrays of `SHARD_ROWS` vectors read with `np.memmap`, and an
+index of fixed-size `(digest, shard, row)` records. Both are append-only, vectors are written before their index
+records: a crashed writer never leaves a record pointing at missing data, and the rows it wrote without records
+are overwritten by the next writer. Writers of several processes are serialised with an exclusive `flock`.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 16k text-embedding-3-large vectors are 200 MB
+SHARD_ROWS = 16_384
+# Raw SHA-256 digests, "S32" would strip trailing zero bytes
+INDEX_RECORD = np.dtype([("digest", "V32"), ("shard", "<u4"), ("row", "<u4")])
+
+
+class EmbeddingStore:
+    def __init__(self, model: str, root: Path | None = None):
+        self.model = model
+        root = Path(root or settings.EMBEDDING_STORE_DIR)
+        self.path = root / re.sub(r"[^A-Za-z0-9_.-]+", "--", model)
+        self.dim = None
+        self._index = {}
+        self._index_size = 0
+        # Last shard and its number of indexed rows, where the next vectors are appended
+        self._tail = (0, 0)
+        self._shards = {}
+        self._read_meta()
+
+    def __len__(self) -> int:
+        self._refresh_index()
+        return len(self._index)
+
+    def _read_meta(self):
+        meta = self.path / "meta.json"
+        if meta.is_file():
+            self.dim = json.loads(meta.read_text())["dim"]
+
+    def _refresh_index(self):
+        """Read the index records appended since the last call, by this or another process."""
+        index = self.path / "index.bin"
+        if not index.is_file():
+            return
+        # A record being appended right now is read the next time
+        size = index.stat().st_size // INDEX_RECORD.itemsize * INDEX_RECORD.itemsize
+        if size <= self._index_size:
+            return
+        with index.open("rb") as fh:
+            fh.seek(self._index_size)
+            records = np.frombuffer(fh.read(size - self._index_size), dtype=INDEX_RECORD)
+        locations = zip(records["shard"].tolist(), records["row"].tolist(), strict=True)
+        digests = records["digest"].tobytes()
+        keys = [digests[start : start + 32] for start in range(0, len(digests), 32)]
+        self._index.update(zip(keys, locations, strict=True))
+        self._index_size = size
+        if len(records):
+            self._tail = max(self._tail, (int(records["shard"][-1]), int(records["row"][-1]) + 1))
+
+    def _shard(self, number: int, rows: int) -> np.memmap:
+        shard = self._shards.get(number)
+        if shard is None or shard.shape[0] < rows:
+            # Shards grow while they are filled, a mapping only covers the rows that existed when it was made
+            path = self.path / f"shard-{number:05d}.f32"
+            shape = (path.stat().st_size // (4 * self.dim), self.dim)
+            shard = np.memmap(path, dtype="<f4", mode="r", shape=shape)
+            self._shards[number] = shard
+        return shard
+
+    def get(self, digests: list[str]) -> tuple[list[int], np.ndarray]:
+        """Positions of the hex `digests` that are stored and their vectors (in that order)."""
+        self._refresh_index()
+        if self.dim is None:
+            self._read_meta()
+        if not self._index or self.dim is None:
+            return [], np.empty((0, self.dim or 0), dtype=np.float32)
+
+        found, locations = [], []
+        for position, digest in enumerate(digests):
+            location = self._index.get(bytes.fromhex(digest))
+            if location is not None:
+                found.append(position)
+                locations.append(location)
+        vectors = np.empty((len(found), self.dim), dtype=np.float32)
+        for i, (shard, row) in enumerate(locations):
+            vectors[i] = self._shard(shard, row + 1)[row]
+        return found, vectors
+
+    @contextmanager
+    def _lock(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with (self.path / "lock").open("a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def put(self, digests: list[str], vectors) -> int:
+        """Store the vectors of the hex `digests` that are not stored yet, returns how many were added."""
+        vectors = np.asarray(vectors, dtype="<f4")
+        if not len(digests):
+            return 0
+        with self._lock():
+            self._refresh_index()
+            if self.dim is None:
+                self._read_meta()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                (self.path / "meta.json").write_text(json.dumps({"model": self.model, "dim": self.dim}))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"{self.model} vectors have {self.dim} dimensions, got {vectors.shape[1]}")
+
+            keys, rows, seen = [], [], set()
+            for row, digest in enumerate(digests):
+                key = bytes.fromhex(digest)
+                if key not in self._index and key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+                    rows.append(row)
+            if not keys:
+                return 0
+
+            number, filled = self._tail
+            records = np.empty(len(keys), dtype=INDEX_RECORD)
+            start = 0
+            while start < len(keys):
+                if filled == SHARD_ROWS:
+                    number, filled = number + 1, 0
+                count = min(SHARD_ROWS - filled, len(keys) - start)
+                with (self.path / f"shard-{number:05d}.f32").open("ab") as fh:
+                    # Drop the rows a crashed writer appended without index records
+                    os.truncate(fh.fileno(), filled * 4 * self.dim)
+                    fh.write(vectors[rows[start : start + count]].tobytes())
+                records["shard"][start : start + count] = number
+                records["row"][start : start + count] = np.arange(filled, filled + count)
+                start += count
+                filled += count
+            records["digest"] = np.frombuffer(b"".join(keys), dtype="V32")
+
+            with (self.path / "index.bin").open("ab") as fh:
+                fh.write(records.tobytes())
+            self._refresh_index()
+        return len(keys)
+
+
+_stores = {}
+
+
+def get_store(model: str) -> EmbeddingStore:
+    """The store of `model`, one instance per process."""
+    if model not in _stores:
+        _stores[model] = EmbeddingStore(model)
+    return _stores[model]
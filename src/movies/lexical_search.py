@@ -0,0 +1,62 @@
+"""
+Full-text search over `MotnShow.search_document` and reciprocal rank fusion with vector search results.
+
+Names, title words and places ("King Alfred", "New York") are matched literally here, where the embedding
+only captures them loosely. The lexical leg needs no embedding, so it also serves as a fallback
+when the embedding provider is slow.
+"""
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F
+
+from .embedding_cache import normalize_query
+from .models import MotnShow
+
+# Terms beyond this are ignored, long queries are better served by the vector leg anyway
+MAX_QUERY_TERMS = 16
+
+
+def build_search_query(raw_query: str) -> SearchQuery | None:
+    """
+    Match shows containing any of the query terms, shows matching more (and higher weighted) terms rank higher.
+
+    Every term is parsed with `plainto_tsquery`, so user input cannot inject tsquery syntax.
+    Returns None for queries without terms.
+    """
+    terms = normalize_query(raw_query).split()[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+
+    query = SearchQuery(terms[0], config=settings.SEARCH_TEXT_CONFIG)
+    for term in terms[1:]:
+        query |= SearchQuery(term, config=settings.SEARCH_TEXT_CONFIG)
+    return query
+
+
+def lexical_search_ids(raw_query: str, top_k: int, queryset=None, exclude_ids=None) -> list[tuple[int, float]]:
+    """Return `(show_id, rank)` pairs of the `top_k` best full-text matches, best first (served by the GIN index)."""
+    query = build_search_query(raw_query)
+    if query is None:
+        return []
+
+    qs = MotnShow.objects.all() if queryset is None else queryset
+    if exclude_ids:
+        qs = qs.exclude(id__in=exclude_ids)
+    qs = qs.filter(search_document=query).annotate(rank=SearchRank(F("search_document"), query)).order_by("-rank", "id")
+    return list(qs.values_list("id", "rank")[:top_k])
+
+
+def reciprocal_rank_fusion(*rankings: list[tuple[int, float]], k: int | None = None) -> list[int]:
+    """
+    Merge rankings of `(show_id, score)` pairs into one list of show ids, best first.
+
+    Each show scores `sum(1 / (k + rank))` over the rankings it appears in, only the positions count,
+    so cosine distances and text ranks need no common scale.
+    """
+    k = settings.SEARCH_HYBRID_RRF_K if k is None else k
+    scores = {}
+    for ranking in rankings:
+        for rank, (show_id, _) in enumerate(ranking, start=1):
+            scores[show_id] = scores.get(show_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda show_id: -scores[show_id])
@@ -0,0 +1,67 @@
+"""
+Local CPU text encoder (sentence-transformers), an alternative to the OpenAI embeddings API.
+
+The model is loaded once per process and shared by all Streamlit sessions: loading takes seconds,
+encoding a query afterwards a few milliseconds without any network round trip. Vectors are L2-normalised,
+have `LOCAL_EMBEDDING_DIM` dimensions and are compared with `MotnShow.embedding_local`.
+
+Set `LOCAL_EMBEDDING_ONNX_FILE` to run an ONNX export (e.g. an int8-quantised one) with onnxruntime
+instead of torch, this needs `sentence-transformers[onnx]`.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LocalEncoder:
+    def __init__(self, model_name: str | None = None, onnx_file: str | None = None):
+        self.model_name = model_name or settings.LOCAL_EMBEDDING_MODEL
+        self.onnx_file = onnx_file or settings.LOCAL_EMBEDDING_ONNX_FILE
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+
+        started = time.perf_counter()
+        kwargs = {}
+        if self.onnx_file:
+            kwargs = {"backend": "onnx", "model_kwargs": {"file_name": self.onnx_file}}
+        model = SentenceTransformer(self.model_name, device="cpu", **kwargs)
+
+        dim = model.get_sentence_embedding_dimension()
+        if dim != settings.LOCAL_EMBEDDING_DIM:
+            raise ValueError(
+                f"{self.model_name} produces {dim} dimensions, LOCAL_EMBEDDING_DIM is {settings.LOCAL_EMBEDDING_DIM}"
+            )
+
+        # The first call allocates buffers and picks kernels, keep it out of the first search
+        model.encode(["warm up"])
+        logger.info("Loaded local encoder %s in %.1f s", self.model_name, time.perf_counter() - started)
+        return model
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+        return self._model
+
+    def warm_up(self):
+        """Load the model now instead of on the first search."""
+        return self.model
+
+    def encode(self, texts: list[str], batch_size: int = 64) -> np.ndarray:
+        """(n, LOCAL_EMBEDDING_DIM) float32 array of normalised embeddings, in the order of `texts`."""
+        embeddings = self.model.encode(list(texts), batch_size=batch_size, normalize_embeddings=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+local_encoder = LocalEncoder()
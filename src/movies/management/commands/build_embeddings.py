@@ -1,11 +1,15 @@
-from collections.abc import Iterable
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from django.conf import settings
-from django.core.management.base import BaseCommand, CommandParser
-from openai import OpenAI
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections
+from django.db.models import Min
 
-from core.settings import env
-from movies.models import MotnShow
+from movies.embedding_jobs import backend_target, job_name, plan_job, release_claims, run_worker
+from movies.models import EmbeddingJobRange, UserViewInteraction
+from movies.taste_profile import rebuild_taste_profiles
 
 
 class Command(BaseCommand):
@@ -14,7 +18,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument(
             "--backend",
-            choices=["sentence-transformer", "openai"],
+            choices=["sentence-transformer", "openai", "openai-batch"],
             default="openai",
             help="Embedding backend to use.",
         )
@@ -25,63 +29,101 @@ class Command(BaseCommand):
             help="Limit number of records to embed.",
         )
         parser.add_argument(
-            "--offset",
+            "--after-id",
             type=int,
-            default=0,
-            help="Offset for batching through the queryset.",
+            default=None,
+            help="Only embed titles with a higher id.",
+        )
+        parser.add_argument(
+            "--only-changed",
+            action="store_true",
+            help="Only embed titles whose text or embedding model changed since they were embedded.",
+        )
+        parser.add_argument(
+            "--no-store",
+            action="store_true",
+            help="Compute all vectors with the backend instead of taking known ones from the on-disk store.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue the last run of this backend from its checkpoints instead of starting a new one.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Worker processes, each claims ranges of titles.",
+        )
+        parser.add_argument(
+            "--range-size",
+            type=int,
+            default=None,
+            help=(
+                f"Titles per claimed range (default {settings.EMBED_BUILD_RANGE_SIZE}, "
+                f"{settings.EMBED_BATCH_RANGE_SIZE} per Batch API job with openai-batch)."
+            ),
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=settings.EMBED_BUILD_PAGE_SIZE,
+            help="Titles per page, progress is checkpointed after every page.",
         )
 
     def handle(self, *args, **options):
         backend = options["backend"]
-        limit = options["limit"]
-        offset = options["offset"]
-
-        qs = MotnShow.objects.exclude(overview="")[offset:]
-        if limit is not None:
-            qs = qs[:limit]
-
-        total = qs.count()
-        self.stdout.write(f"Computing embeddings for {total} titles using backend={backend}")
-
-        if backend == "openai":
-            embed_fn = self._embed_with_openai
-            batch_size = 1000
-        else:
-            embed_fn = self._embed_with_sentence_transformer
-            batch_size = 256
-
-        for start in range(0, total, batch_size):
-            batch = list(qs[start : start + batch_size])
-            texts = [t.embedding_text for t in batch]
-
-            embs = embed_fn(texts)
-
-            for obj, emb in zip(batch, embs, strict=True):
-                obj.embedding = emb
-                obj.save(update_fields=["embedding"])
-
-            self.stdout.write(f"Processed {start + len(batch)}/{total}")
-
-    def _embed_with_sentence_transformer(self, texts: Iterable[str]):
-        if not hasattr(self, "_st_model"):
-            from sentence_transformers import SentenceTransformer
-
-            self._st_model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", device="cpu")
-
-        embeddings = self._st_model.encode(list(texts), normalize_embeddings=True)
-        padded = []
-        for emb in embeddings:
-            emb_list = emb.tolist()
-            # pad to target dimension for storage compatibility
-            if len(emb_list) < settings.OPENAI_EMBEDDING_DIM:
-                emb_list = emb_list + [0.0] * (settings.OPENAI_EMBEDDING_DIM - len(emb_list))
-            padded.append(emb_list)
-        return padded
-
-    def _embed_with_openai(self, texts: Iterable[str]):
-        client = OpenAI(api_key=env("OPENAI_API_KEY"))
-        response = client.embeddings.create(
-            model=settings.OPENAI_EMBEDDING_MODEL,
-            input=list(texts),
+        only_changed = options["only_changed"]
+        use_store = not options["no_store"]
+        page_size = options["page_size"]
+        workers = max(options["workers"], 1)
+        range_size = options["range_size"] or (
+            settings.EMBED_BATCH_RANGE_SIZE if backend == "openai-batch" else settings.EMBED_BUILD_RANGE_SIZE
         )
-        return [item.embedding for item in response.data]
+        job = job_name(backend)
+        field, _ = backend_target(backend)
+
+        if options["resume"]:
+            if not EmbeddingJobRange.objects.filter(job=job).exists():
+                raise CommandError(f"There is no run of {job} to resume")
+            pending_ranges = release_claims(job)
+            self.stdout.write(f"Resuming {job} with {pending_ranges} unfinished ranges")
+        else:
+            total = plan_job(job, range_size, after_id=options["after_id"], limit=options["limit"])
+            self.stdout.write(f"Computing embeddings for {total} titles using backend={backend}")
+
+        # Progress of the ranges is logged by movies.embedding_jobs, forked workers inherit the handler
+        progress = logging.getLogger("movies.embedding_jobs")
+        handler = logging.StreamHandler(self.stdout)
+        if options["verbosity"] > 0:
+            progress.addHandler(handler)
+            progress.setLevel(logging.INFO)
+        try:
+            if workers == 1:
+                embedded = run_worker(job, backend, only_changed, page_size, use_store)
+            else:
+                # Each forked worker must open its own database connection, an inherited one would be shared
+                connections.close_all()
+                context = multiprocessing.get_context("fork")
+                with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                    futures = [
+                        executor.submit(run_worker, job, backend, only_changed, page_size, use_store)
+                        for _ in range(workers)
+                    ]
+                    embedded = sum(future.result() for future in futures)
+        finally:
+            progress.removeHandler(handler)
+        self.stdout.write(f"Embedded {embedded} titles")
+
+        started = EmbeddingJobRange.objects.filter(job=job).aggregate(started=Min("created_at"))["started"]
+        if field == "embedding" and started is not None:
+            # Taste profiles sum the show embeddings, rebuild those of users who interacted with the changed shows
+            # (also those embedded before a resumed run crashed)
+            user_ids = list(
+                UserViewInteraction.objects.filter(show__updated_at__gte=started)
+                .values_list("user_id", flat=True)
+                .distinct()
+            )
+            for start in range(0, len(user_ids), 500):
+                rebuild_taste_profiles(user_ids[start : start + 500])
+            self.stdout.write(f"Rebuilt {len(user_ids)} taste profiles")
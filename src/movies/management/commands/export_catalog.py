@@ -0,0 +1,27 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from movies.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export the shows with their genres and embeddings to a snapshot directory"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "path",
+            nargs="?",
+            type=Path,
+            default=settings.CATALOG_SNAPSHOT_DIR,
+            help="Snapshot directory, created if needed.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        manifest = export_snapshot(options["path"], log=self.stdout.write)
+        self.stdout.write(
+            f"Exported {manifest['shows']} shows to {options['path']} in {time.perf_counter() - started:.1f} s"
+        )
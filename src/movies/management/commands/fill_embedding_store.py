@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from movies.embedding_jobs import backend_target, fill_store_from_database
+from movies.embedding_store import get_store
+
+
+class Command(BaseCommand):
+    help = "Add the embeddings of this database to the on-disk store, for other databases to reuse"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--backend",
+            choices=["sentence-transformer", "openai"],
+            default="openai",
+            help="Embedding backend whose vectors to store.",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=settings.EMBED_BUILD_PAGE_SIZE,
+            help="Titles read per query.",
+        )
+
+    def handle(self, *args, **options):
+        _, model = backend_target(options["backend"])
+        added = fill_store_from_database(options["backend"], options["page_size"])
+        self.stdout.write(f"Added {added} vectors, the store of {model} has {len(get_store(model))}")
@@ -0,0 +1,28 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from movies.snapshot import import_snapshot
+
+
+class Command(BaseCommand):
+    help = "Insert or update the shows, genres and embeddings of a snapshot made by export_catalog"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "path",
+            nargs="?",
+            type=Path,
+            default=settings.CATALOG_SNAPSHOT_DIR,
+            help="Snapshot directory.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            imported = import_snapshot(options["path"], log=self.stdout.write)
+        except ValueError as exc:
+            raise CommandError(exc) from exc
+        self.stdout.write(f"Imported {imported} shows in {time.perf_counter() - started:.1f} s")
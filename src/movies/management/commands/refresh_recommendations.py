@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connections
+
+from movies.batch_recommendations import load_catalog, refresh_chunk, set_catalog
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored recommendations of all users with batched matrix products"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Worker processes, 1 computes in this process.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.RECOMMENDATIONS_CHUNK_SIZE,
+            help="Users per task.",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=settings.RECOMMENDATIONS_TOP_K,
+            help="Recommendations stored per user.",
+        )
+
+    def handle(self, *args, **options):
+        workers = max(options["workers"], 1)
+        chunk_size = options["chunk_size"]
+        top_k = options["top_k"]
+        started = time.perf_counter()
+
+        user_ids = list(get_user_model().objects.filter(is_active=True).order_by("id").values_list("id", flat=True))
+        chunks = [user_ids[start : start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+        catalog = load_catalog()
+        set_catalog(catalog)
+        self.stdout.write(
+            f"Recommending for {len(user_ids)} users from {len(catalog[0])} shows "
+            f"in {len(chunks)} chunks with {workers} workers"
+        )
+
+        done = 0
+        if workers == 1:
+            for chunk in chunks:
+                done += refresh_chunk(chunk, top_k)
+                self.stdout.write(f"Processed {done}/{len(user_ids)}")
+        else:
+            # Forked workers share the catalog matrix with this process, copy-on-write.
+            # Each must open its own database connection, an inherited one would be shared.
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [executor.submit(refresh_chunk, chunk, top_k) for chunk in chunks]
+                for future in as_completed(futures):
+                    done += future.result()
+                    self.stdout.write(f"Processed {done}/{len(user_ids)}")
+
+        self.stdout.write(f"Refreshed recommendations in {time.perf_counter() - started:.1f} s")
@@ -0,0 +1,21 @@
+# Generated by Django 6.0 on 2026-10-17 04:10
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+import pgvector.django.halfvec
+import pgvector.django.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0006_userquerylog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='motnshow',
+            index=pgvector.django.indexes.HnswIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.comparison.Cast('embedding', pgvector.django.halfvec.HalfVectorField(dimensions=3072)), name='halfvec_cosine_ops'), ef_construction=64, m=16, name='motnshow_embedding_hnsw'),
+        ),
+    ]
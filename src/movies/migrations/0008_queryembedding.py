@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-17 04:13
+
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0007_motnshow_embedding_hnsw'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('text_hash', models.CharField(help_text='sha256 of the normalized query text.', max_length=64)),
+                ('text', models.TextField()),
+                ('embedding', pgvector.django.vector.VectorField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='movies_quer_last_us_848a7e_idx')],
+                'unique_together': {('model', 'text_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-17 04:14
+
+import django.db.models.functions.comparison
+import pgvector.django.indexes
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0008_queryembedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_short',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(models.Func(models.Func('embedding', 1, 512, function='subvector'), function='l2_normalize'), pgvector.django.vector.VectorField(dimensions=512)), output_field=pgvector.django.vector.VectorField(dimensions=512)),
+        ),
+        migrations.AddIndex(
+            model_name='motnshow',
+            index=pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding_short'], m=16, name='motnshow_embedding_short_hnsw', opclasses=['vector_cosine_ops']),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-17 04:14
+
+import django.db.models.functions.comparison
+import pgvector.django.bit
+import pgvector.django.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0009_motnshow_embedding_short'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_bit',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(models.Func('embedding', function='binary_quantize'), pgvector.django.bit.BitField(length=3072)), output_field=pgvector.django.bit.BitField(length=3072)),
+        ),
+        migrations.AddIndex(
+            model_name='motnshow',
+            index=pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding_bit'], m=16, name='motnshow_embedding_bit_hnsw', opclasses=['bit_hamming_ops']),
+        ),
+    ]
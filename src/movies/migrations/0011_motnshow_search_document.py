@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-17 04:20
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import movies.models.motn
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0010_motnshow_embedding_bit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motnshow',
+            name='search_document',
+            field=models.GeneratedField(db_persist=True, expression=django.contrib.postgres.search.CombinedSearchVector(django.contrib.postgres.search.CombinedSearchVector(django.contrib.postgres.search.CombinedSearchVector(django.contrib.postgres.search.SearchVector('title', 'original_title', config='english', weight='A'), '||', movies.models.motn.JSONSearchVector('cast', 'english', 'B'), django.contrib.postgres.search.SearchConfig('english')), '||', movies.models.motn.JSONSearchVector('tags', 'english', 'C'), django.contrib.postgres.search.SearchConfig('english')), '||', django.contrib.postgres.search.SearchVector('overview', config='english', weight='D'), django.contrib.postgres.search.SearchConfig('english')), output_field=django.contrib.postgres.search.SearchVectorField()),
+        ),
+        migrations.AddIndex(
+            model_name='motnshow',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='motnshow_search_document_gin'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-17 04:22
+
+import pgvector.django.indexes
+import pgvector.django.vector
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0011_motnshow_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_local',
+            field=pgvector.django.vector.VectorField(blank=True, dimensions=384, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='motnshow',
+            index=pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding_local'], m=16, name='motnshow_embedding_local_hnsw', opclasses=['vector_cosine_ops']),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 6.0 on 2026-10-17 04:24
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0012_motnshow_embedding_local'),
+    ]
+
+    operations = [
+        TrigramExtension(),  # Ensures the pg_trgm extension is enabled in Postgres
+        migrations.AddIndex(
+            model_name='queryembedding',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('text', name='gin_trgm_ops'), name='queryembedding_text_trgm'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 04:28
+
+import django.db.models.deletion
+import pgvector.django.vector
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0013_queryembedding_text_trgm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTasteProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vector_sum', pgvector.django.vector.VectorField(blank=True, dimensions=3072, null=True)),
+                ('weight_total', models.FloatField(default=0.0)),
+                ('item_count', models.PositiveIntegerField(default=0, help_text='Interactions with an embedded show.')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='taste_profile', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
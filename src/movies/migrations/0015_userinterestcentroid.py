@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-17 04:32
+
+import django.db.models.deletion
+import pgvector.django.vector
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0014_usertasteprofile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertasteprofile',
+            name='centroids_stale',
+            field=models.BooleanField(default=True, help_text='Interactions changed since the interest centroids were computed.'),
+        ),
+        migrations.CreateModel(
+            name='UserInterestCentroid',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vector', pgvector.django.vector.VectorField(dimensions=3072)),
+                ('weight', models.FloatField(help_text="Share of the user's interaction weight in this cluster.")),
+                ('item_count', models.PositiveIntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='interest_centroids', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-weight'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 04:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0015_userinterestcentroid'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationRefreshJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_requested_at', models.DateTimeField()),
+                ('requested_at', models.DateTimeField()),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('claimed_at', models.DateTimeField(blank=True, help_text='Set while a worker recomputes.', null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='recommendation_refresh_job', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
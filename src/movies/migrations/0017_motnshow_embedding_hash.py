@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-17 04:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0016_recommendationrefreshjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the embedded text.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_local_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the embedded text.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_local_model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='motnshow',
+            name='embedding_model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-17 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0017_motnshow_embedding_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingJobRange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(help_text='Embedded field and model, e.g. "embedding:text-embedding-3-large".', max_length=150)),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('done_id', models.BigIntegerField(blank=True, null=True)),
+                ('embedded', models.PositiveIntegerField(default=0)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['job', 'first_id'],
+                'unique_together': {('job', 'first_id')},
+            },
+        ),
+    ]
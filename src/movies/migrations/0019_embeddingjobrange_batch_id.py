@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 04:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0018_embeddingjobrange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='embeddingjobrange',
+            name='batch_id',
+            field=models.CharField(blank=True, help_text='Batch API job of the range, once submitted.', max_length=100),
+        ),
+    ]
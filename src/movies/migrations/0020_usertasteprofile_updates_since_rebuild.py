@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0019_embeddingjobrange_batch_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertasteprofile',
+            name='updates_since_rebuild',
+            field=models.PositiveIntegerField(default=0, help_text='Incremental updates since the sums were recomputed from all interactions.'),
+        ),
+    ]
@@ -1,6 +1,14 @@
+from .cache import QueryEmbedding
 from .imdb import ImdbGenre, ImdbMovie, ImdbMovieGenre, ImdbTitleType
-from .motn import MotnGenre, MotnShow, MotnShowGenre
-from .user import UserQueryLog, UserRecommendation, UserViewInteraction
+from .motn import EmbeddingJobRange, MotnGenre, MotnShow, MotnShowGenre
+from .user import (
+    RecommendationRefreshJob,
+    UserInterestCentroid,
+    UserQueryLog,
+    UserRecommendation,
+    UserTasteProfile,
+    UserViewInteraction,
+)
 
 __all__ = [
     "ImdbGenre",
@@ -10,7 +18,12 @@ __all__ = [
     "MotnGenre",
     "MotnShow",
     "MotnShowGenre",
+    "EmbeddingJobRange",
     "UserViewInteraction",
     "UserRecommendation",
+    "RecommendationRefreshJob",
+    "UserTasteProfile",
+    "UserInterestCentroid",
     "UserQueryLog",
+    "QueryEmbedding",
 ]
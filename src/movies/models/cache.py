@@ -0,0 +1,30 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.db import models
+from pgvector.django import VectorField
+
+
+class QueryEmbedding(models.Model):
+    """
+    Persistent tier of the query embedding cache, see `movies.embedding_cache`.
+    """
+
+    model = models.CharField(max_length=100)
+    text_hash = models.CharField(max_length=64, help_text="sha256 of the normalized query text.")
+    text = models.TextField()
+    # No dimensions, so embeddings of different models can be cached side by side
+    embedding = VectorField()
+
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("model", "text_hash")
+        indexes = [
+            models.Index(fields=["last_used_at"]),
+            # Finds near-identical queries, see `QueryEmbeddingCache.get_similar`
+            GinIndex(OpClass("text", name="gin_trgm_ops"), name="queryembedding_text_trgm"),
+        ]
+
+    def __str__(self):
+        return f"{self.model}: {self.text[:50]}"
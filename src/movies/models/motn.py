@@ -1,7 +1,27 @@
 from django.conf import settings
 from django.contrib.postgres.fields.array import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchConfig, SearchVector, SearchVectorCombinable, SearchVectorField
 from django.db import models
-from pgvector.django import VectorField
+from django.db.models import Func, Value
+from django.db.models.functions import Cast
+from pgvector.django import BitField, HalfVectorField, HnswIndex, VectorField
+
+
+class JSONSearchVector(SearchVectorCombinable, Func):
+    """Weighted `to_tsvector(config, jsonb)`, only the string values of the JSON (e.g. cast names, tags) are indexed."""
+
+    function = "to_tsvector"
+    output_field = SearchVectorField()
+
+    def __init__(self, expression, config, weight):
+        super().__init__(SearchConfig.from_parameter(config), expression)
+        self.weight = Value(weight)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        weight_sql, weight_params = compiler.compile(self.weight)
+        return f"setweight({sql}, {weight_sql})", (*params, *weight_params)
 
 
 class MotnShow(models.Model):
@@ -109,6 +129,39 @@ class MotnShow(models.Model):
     # Generated
 
     embedding = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM, null=True, blank=True)
+    # What the vector was computed from, `build_embeddings --only-changed` re-embeds only when either differs
+    embedding_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the embedded text.")
+    embedding_model = models.CharField(max_length=100, blank=True)
+    # text-embedding-3 vectors can be truncated, a renormalised prefix is used to shortlist candidates cheaply
+    embedding_short = models.GeneratedField(
+        expression=Cast(
+            Func(Func("embedding", 1, settings.EMBEDDING_SHORT_DIM, function="subvector"), function="l2_normalize"),
+            VectorField(dimensions=settings.EMBEDDING_SHORT_DIM),
+        ),
+        output_field=VectorField(dimensions=settings.EMBEDDING_SHORT_DIM),
+        db_persist=True,
+    )
+    # Sign quantisation (1 bit per dimension, 32x smaller than float32) to shortlist candidates by Hamming distance
+    embedding_bit = models.GeneratedField(
+        expression=Cast(Func("embedding", function="binary_quantize"), BitField(length=settings.OPENAI_EMBEDDING_DIM)),
+        output_field=BitField(length=settings.OPENAI_EMBEDDING_DIM),
+        db_persist=True,
+    )
+    # Native-dimension vectors of the local CPU encoder, see `movies.local_encoder`
+    embedding_local = VectorField(dimensions=settings.LOCAL_EMBEDDING_DIM, null=True, blank=True)
+    embedding_local_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the embedded text.")
+    embedding_local_model = models.CharField(max_length=100, blank=True)
+    # Full-text document for the lexical leg of hybrid search, titles rank above cast, tags and plot
+    search_document = models.GeneratedField(
+        expression=(
+            SearchVector("title", "original_title", config=settings.SEARCH_TEXT_CONFIG, weight="A")
+            + JSONSearchVector("cast", settings.SEARCH_TEXT_CONFIG, "B")
+            + JSONSearchVector("tags", settings.SEARCH_TEXT_CONFIG, "C")
+            + SearchVector("overview", config=settings.SEARCH_TEXT_CONFIG, weight="D")
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
     # plot_embedding = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM, null=True, blank=True)
     # meta_embedding = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM, null=True, blank=True)
     # tone_embedding = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM, null=True, blank=True)
@@ -127,6 +180,38 @@ class MotnShow(models.Model):
             models.Index(fields=["imdb_id"]),
             models.Index(fields=["tmdb_id"]),
             models.Index(fields=["show_type", "year"]),
+            # Search queries must use the same cast expression, see `movies.search.embedding_distance`
+            HnswIndex(
+                OpClass(
+                    Cast("embedding", HalfVectorField(dimensions=settings.OPENAI_EMBEDDING_DIM)),
+                    name="halfvec_cosine_ops",
+                ),
+                name="motnshow_embedding_hnsw",
+                m=settings.VECTOR_INDEX_HNSW_M,
+                ef_construction=settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+            ),
+            HnswIndex(
+                fields=["embedding_short"],
+                name="motnshow_embedding_short_hnsw",
+                opclasses=["vector_cosine_ops"],
+                m=settings.VECTOR_INDEX_HNSW_M,
+                ef_construction=settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+            ),
+            HnswIndex(
+                fields=["embedding_local"],
+                name="motnshow_embedding_local_hnsw",
+                opclasses=["vector_cosine_ops"],
+                m=settings.VECTOR_INDEX_HNSW_M,
+                ef_construction=settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+            ),
+            GinIndex(fields=["search_document"], name="motnshow_search_document_gin"),
+            HnswIndex(
+                fields=["embedding_bit"],
+                name="motnshow_embedding_bit_hnsw",
+                opclasses=["bit_hamming_ops"],
+                m=settings.VECTOR_INDEX_HNSW_M,
+                ef_construction=settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+            ),
         ]
 
     def __str__(self) -> str:
@@ -188,7 +273,34 @@ class MotnShow(models.Model):
             parts.append("Plot: " + self.overview)
 
         return ". ".join(parts) + "."
-        #return self.overview
+        # return self.overview
+
+
+class EmbeddingJobRange(models.Model):
+    """
+    A range of `MotnShow` ids of a `build_embeddings` run, processed by one worker at a time.
+
+    `done_id` is the checkpoint: the rows up to it are embedded, a resumed run continues after it.
+    """
+
+    job = models.CharField(
+        max_length=150, help_text='Embedded field and model, e.g. "embedding:text-embedding-3-large".'
+    )
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    done_id = models.BigIntegerField(null=True, blank=True)
+    batch_id = models.CharField(max_length=100, blank=True, help_text="Batch API job of the range, once submitted.")
+    embedded = models.PositiveIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("job", "first_id")
+        ordering = ["job", "first_id"]
+
+    def __str__(self):
+        return f"{self.job} {self.first_id}-{self.last_id} (done up to {self.done_id})"
 
 
 class MotnGenre(models.Model):
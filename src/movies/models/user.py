@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import models
+from pgvector.django import VectorField
 
 
 class UserViewInteraction(models.Model):
@@ -29,15 +30,78 @@ class UserRecommendation(models.Model):
         return f"Recommendations for {self.user} (updated {self.updated_at})"
 
 
+class RecommendationRefreshJob(models.Model):
+    """
+    A pending recomputation of the user's `UserRecommendation`, processed by `movies.recommendation_queue`.
+
+    There is at most one job per user: further requests only move `run_after`, so a burst of ratings
+    is coalesced into one recomputation.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="recommendation_refresh_job"
+    )
+    first_requested_at = models.DateTimeField()
+    requested_at = models.DateTimeField()
+    run_after = models.DateTimeField(db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text="Set while a worker recomputes.")
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    def __str__(self):
+        return f"Recommendation refresh of {self.user} after {self.run_after}"
+
+
+class UserTasteProfile(models.Model):
+    """
+    Running sums behind the user's taste vector, kept up to date per interaction by `movies.taste_profile`.
+
+    The taste vector is `vector_sum` normalised, the same direction as the weighted average of the embeddings.
+    """
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="taste_profile")
+    vector_sum = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM, null=True, blank=True)
+    weight_total = models.FloatField(default=0.0)
+    item_count = models.PositiveIntegerField(default=0, help_text="Interactions with an embedded show.")
+    centroids_stale = models.BooleanField(
+        default=True, help_text="Interactions changed since the interest centroids were computed."
+    )
+    updates_since_rebuild = models.PositiveIntegerField(
+        default=0, help_text="Incremental updates since the sums were recomputed from all interactions."
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Taste profile of {self.user} ({self.item_count} shows)"
+
+
+class UserInterestCentroid(models.Model):
+    """
+    One of the user's interests: the normalised centre of a cluster of their interactions' embeddings.
+
+    Computed on demand by `movies.taste_profile.get_interest_centroids` when `UserTasteProfile.centroids_stale`.
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="interest_centroids")
+    vector = VectorField(dimensions=settings.OPENAI_EMBEDDING_DIM)
+    weight = models.FloatField(help_text="Share of the user's interaction weight in this cluster.")
+    item_count = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ["-weight"]
+
+    def __str__(self):
+        return f"Interest of {self.user} ({self.item_count} shows, weight {self.weight:.2f})"
+
+
 class UserQueryLog(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
     query = models.TextField()
     top_k = models.IntegerField(default=50)
-    
+
     # Store just the IDs of the results to save space, or a small JSON dump
     result_ids = models.JSONField(default=list)
     result_metadata_dump = models.JSONField(default=dict, blank=True, help_text="Search metadata like structured query")
-    
+
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -0,0 +1,110 @@
+"""
+Buffered writer for `UserQueryLog`.
+
+Searches put unsaved log rows on a bounded queue, a background thread writes them with `bulk_create`
+every `QUERY_LOG_BATCH_SIZE` rows or `QUERY_LOG_FLUSH_INTERVAL_MS` milliseconds. When the queue is full
+new rows are dropped, so logging never slows down or fails a search. Pending rows are flushed at exit.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import UserQueryLog
+
+logger = logging.getLogger(__name__)
+
+
+class QueryLogWriter:
+    def __init__(
+        self,
+        batch_size: int | None = None,
+        flush_interval_ms: int | None = None,
+        max_queue: int | None = None,
+    ):
+        self.batch_size = batch_size or settings.QUERY_LOG_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms or settings.QUERY_LOG_FLUSH_INTERVAL_MS) / 1000
+        self._queue = queue.Queue(maxsize=max_queue or settings.QUERY_LOG_MAX_QUEUE)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.stats = {"written": 0, "dropped": 0, "failed": 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, entry: UserQueryLog) -> bool:
+        """Queue an unsaved log row, returns False when it was dropped because the queue is full."""
+        if self._stopping.is_set():
+            self._count("dropped")
+            return False
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        return True
+
+    def _write(self, batch: list[UserQueryLog]):
+        close_old_connections()
+        try:
+            UserQueryLog.objects.bulk_create(batch)
+            self._count("written", len(batch))
+        except Exception:
+            self._count("failed", len(batch))
+            logger.exception("Failed to write %s query log rows", len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._write(batch)
+        close_old_connections()
+
+    def flush(self):
+        """Block until every queued row has been written (or failed)."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self, timeout: float = 5.0):
+        """Stop accepting rows and write the remaining ones."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+query_log_writer = QueryLogWriter()
+atexit.register(query_log_writer.close)
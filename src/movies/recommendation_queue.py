@@ -0,0 +1,118 @@
+"""
+Debounced background refreshes of `UserRecommendation`.
+
+Rating a show or importing a viewing history only calls `request()`, which upserts the user's
+`RecommendationRefreshJob` and returns at once. A background thread recomputes the recommendations
+`RECOMMENDATIONS_REFRESH_DEBOUNCE` seconds after the last request of a burst, so 30 ratings in a row cause
+a single recomputation and page loads never wait for one.
+
+Jobs live in the database: requests made before a restart are still processed afterwards, and several
+Streamlit processes can run workers side by side (jobs are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`).
+A job is only deleted when it was not requested again while being processed.
+"""
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import RecommendationRefreshJob
+from .search import update_user_recommendations
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationRefresher:
+    def __init__(
+        self,
+        debounce: float | None = None,
+        max_delay: float | None = None,
+        poll_interval: float | None = None,
+        lease: float | None = None,
+        batch_size: int = 20,
+    ):
+        self.debounce = timedelta(seconds=settings.RECOMMENDATIONS_REFRESH_DEBOUNCE if debounce is None else debounce)
+        self.max_delay = timedelta(
+            seconds=settings.RECOMMENDATIONS_REFRESH_MAX_DELAY if max_delay is None else max_delay
+        )
+        self.poll_interval = poll_interval or settings.RECOMMENDATIONS_REFRESH_POLL_INTERVAL
+        self.lease = timedelta(seconds=lease or settings.RECOMMENDATIONS_REFRESH_LEASE)
+        self.batch_size = batch_size
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def request(self, user_id: int):
+        """Queue a refresh of the user's recommendations, or postpone the one already queued."""
+        user_id = getattr(user_id, "pk", user_id)
+        now = timezone.now()
+        with transaction.atomic():
+            job, created = RecommendationRefreshJob.objects.select_for_update().get_or_create(
+                user_id=user_id,
+                defaults={"first_requested_at": now, "requested_at": now, "run_after": now + self.debounce},
+            )
+            if not created:
+                job.requested_at = now
+                job.run_after = min(now + self.debounce, job.first_requested_at + self.max_delay)
+                job.save(update_fields=["requested_at", "run_after"])
+
+    def start(self):
+        """Start the worker thread of this process, once."""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="recommendation-refresher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            close_old_connections()
+            try:
+                while self.run_pending():
+                    pass
+            except Exception:
+                logger.exception("Recommendation refresh worker failed")
+
+    def _claim(self) -> list[RecommendationRefreshJob]:
+        now = timezone.now()
+        with transaction.atomic():
+            jobs = list(
+                RecommendationRefreshJob.objects.select_for_update(skip_locked=True, of=("self",))
+                .select_related("user")
+                .filter(run_after__lte=now)
+                .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - self.lease))
+                .order_by("run_after")[: self.batch_size]
+            )
+            RecommendationRefreshJob.objects.filter(pk__in=[job.pk for job in jobs]).update(claimed_at=now)
+        return jobs
+
+    def run_pending(self) -> int:
+        """Process the jobs that are due, returns how many were claimed."""
+        jobs = self._claim()
+        for job in jobs:
+            try:
+                update_user_recommendations(job.user)
+            except Exception:
+                logger.exception("Failed to refresh the recommendations of user %s", job.user_id)
+                retry_in = min(self.debounce * 2**job.attempts, self.max_delay)
+                RecommendationRefreshJob.objects.filter(pk=job.pk).update(
+                    claimed_at=None, attempts=F("attempts") + 1, run_after=timezone.now() + retry_in
+                )
+                continue
+
+            deleted, _ = RecommendationRefreshJob.objects.filter(pk=job.pk, requested_at=job.requested_at).delete()
+            if not deleted:
+                # Requested again meanwhile, runs once more after its new run_after
+                RecommendationRefreshJob.objects.filter(pk=job.pk).update(
+                    claimed_at=None, first_requested_at=F("requested_at")
+                )
+        return len(jobs)
+
+
+recommendation_refresher = RecommendationRefresher()
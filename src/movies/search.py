@@ -1,14 +1,28 @@
+import functools
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mlflow
 from django.conf import settings
-from openai import OpenAI
-from pgvector.django import CosineDistance
+from django.db import close_old_connections
+from openai import OpenAI, OpenAIError
 
 from core.settings import env
 from misc.utils.embedding import combine_query_and_user, get_user_embedding
 
-from .models import MotnGenre, MotnShow, UserRecommendation, UserViewInteraction
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .embedding_cache import query_embedding_cache
+from .embedding_dispatcher import EmbeddingDispatcher
+from .lexical_search import lexical_search_ids, reciprocal_rank_fusion
+from .local_encoder import local_encoder
+from .models import MotnGenre, MotnShow, UserQueryLog, UserRecommendation, UserViewInteraction
+from .query_log import query_log_writer
+from .search_backends import SearchTimeout, fetch_shows, fetch_shows_many, get_search_backend
+from .taste_profile import get_interest_centroids
+
+logger = logging.getLogger(__name__)
 
 SYSTEM_PROMPT = """
 You are a query parser for a movie/series recommender.
@@ -54,14 +68,79 @@ Output rules:
 """
 
 
+# Max inputs per embeddings request (the API accepts up to 2048)
+EMBED_BATCH_SIZE = 1000
+
+# Shared by all Streamlit sessions, used to overlap independent search stages
+_executor = ThreadPoolExecutor(max_workers=settings.SEARCH_WORKER_THREADS, thread_name_prefix="search")
+
+
+def run_in_thread(fn, *args, **kwargs):
+    """
+    Run `fn` in the shared search thread pool and return its future.
+
+    Each pool thread has its own database connection, stale ones are closed around every call
+    (there is no request cycle to do this for us).
+    """
+
+    def run():
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return _executor.submit(run)
+
+
+@functools.cache
 def get_openai_client():
-    return OpenAI(api_key=env("OPENAI_API_KEY"))
+    # One client per process, it keeps its HTTP connection pool alive between searches
+    return OpenAI(api_key=env("OPENAI_API_KEY"), base_url=settings.OPENAI_BASE_URL, timeout=settings.OPENAI_TIMEOUT)
 
 
-def embed_text(text: str):
+def _embed_texts_uncached(texts: list[str]) -> list:
     client = get_openai_client()
-    response = client.embeddings.create(model=settings.OPENAI_EMBEDDING_MODEL, input=[text])
-    return response.data[0].embedding
+    embeddings = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        response = client.embeddings.create(
+            model=settings.OPENAI_EMBEDDING_MODEL, input=texts[start : start + EMBED_BATCH_SIZE]
+        )
+        embeddings.extend(item.embedding for item in response.data)
+    return embeddings
+
+
+# Shared by all sessions of this process. While the embeddings API keeps failing or is too slow,
+# requests fail immediately and searches fall back right away (see `search_shows`)
+embedding_circuit = CircuitBreaker(
+    "openai-embeddings",
+    failure_threshold=settings.EMBED_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=settings.EMBED_CIRCUIT_RESET_TIMEOUT,
+    slow_call_ms=settings.EMBED_CIRCUIT_SLOW_CALL_MS,
+)
+embedding_dispatcher = EmbeddingDispatcher(functools.partial(embedding_circuit.call, _embed_texts_uncached))
+
+
+def embed_text(text: str):
+    """
+    Embed a search query, repeated and popular queries are served from the query embedding cache.
+
+    Cache misses of concurrent searches are sent together in one request by `embedding_dispatcher`.
+    """
+    return query_embedding_cache.get_or_embed(
+        settings.OPENAI_EMBEDDING_MODEL, text, embedding_dispatcher.embed
+    ).tolist()
+
+
+def embed_text_local(text: str):
+    """Embed a search query with the local CPU encoder, for the "local" search mode."""
+    return local_encoder.encode([text])[0].tolist()
+
+
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    """Embed many search queries, the ones missing from the cache are sent in batched requests."""
+    embeddings = query_embedding_cache.get_or_embed_many(settings.OPENAI_EMBEDDING_MODEL, texts, _embed_texts_uncached)
+    return [embedding.tolist() for embedding in embeddings]
 
 
 def parse_user_query(raw_query: str) -> dict:
@@ -126,60 +205,338 @@ def build_base_queryset(structured: dict):
     #     qs = qs.filter(year__gte=min_year)
     # if max_year:
     #     qs = qs.filter(year__lte=max_year)
-    return qs.distinct()
+
+    # No DISTINCT here: it forces a full sort and prevents the HNSW index scan,
+    # M2M filters should use `id__in` subqueries instead of joins.
+    return qs
+
+
+def _timed(timings: dict, stage: str, fn, *args, **kwargs):
+    """Call `fn` and record its duration in milliseconds as `timings[stage]`."""
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def _log_query(user, raw_query: str, top_k: int, result_ids: list[int], metadata: dict):
+    # `user` may be a User instance or a user id (the home page passes the id)
+    if isinstance(user, int):
+        user_id = user
+    else:
+        user_id = user.id if (user and user.is_authenticated) else None
+
+    # Written in batches by a background thread, dropped rather than delaying the search when it falls behind
+    query_log_writer.submit(
+        UserQueryLog(
+            user_id=user_id,
+            query=raw_query,
+            top_k=top_k,
+            result_ids=result_ids,
+            result_metadata_dump=metadata,
+        )
+    )
+
+
+def _stored_recommendation_hits(user, top_k: int) -> list[tuple[int, None]]:
+    """The user's last stored recommendations, the last resort of a degraded search."""
+    user_id = user if isinstance(user, int) else getattr(user, "id", None)
+    if user_id is None:
+        return []
+    recommendation = UserRecommendation.objects.filter(user_id=user_id).order_by("-updated_at").first()
+    if recommendation is None:
+        return []
+    return [(show_id, None) for show_id in recommendation.recommended_shows[:top_k]]
+
+
+def search_ids_per_interest(search_backend, q_vecs: list, top_k: int, timeout: float | None = None, **options):
+    """
+    One top-k search per vector (e.g. the query combined with each of the user's interests), run concurrently.
+
+    The rankings are merged by each show's best distance, the vectors are normalised so distances compare.
+    Raises `SearchTimeout` when the searches take longer than `timeout` seconds.
+    """
+    if len(q_vecs) == 1:
+        return search_backend.search_ids(q_vecs[0], top_k, timeout=timeout, **options)
+
+    started = time.perf_counter()
+    futures = [run_in_thread(search_backend.search_ids, q_vec, top_k, timeout=timeout, **options) for q_vec in q_vecs]
+    best = {}
+    for future in futures:
+        try:
+            hits = future.result(timeout=None if timeout is None else max(timeout - (time.perf_counter() - started), 0))
+        except TimeoutError as exc:
+            raise SearchTimeout("Per-interest searches timed out") from exc
+        for show_id, distance in hits:
+            if show_id not in best or distance < best[show_id]:
+                best[show_id] = distance
+    return sorted(best.items(), key=lambda hit: hit[1])[:top_k]
 
 
 @mlflow.trace
-def search_shows(raw_query: str, top_k: int = 20, user=None, alpha: float = 0.5, user_embedding=None):
+def search_shows(
+    raw_query: str,
+    top_k: int = 20,
+    user=None,
+    alpha: float = 0.5,
+    user_embedding=None,
+    ef_search: int | None = None,
+    backend: str | None = None,
+    mode: str | None = None,
+    candidate_multiplier: int | None = None,
+    projection: bool = False,
+    hybrid: bool | None = None,
+    deadline_ms: int | None = None,
+    multi_interest: bool | None = None,
+    stats: dict | None = None,
+):
+    """
+    Search shows for a natural language query, optionally personalised with the user's taste vector.
+
+    The query embedding request and the user vector load are independent and run concurrently,
+    the query log is written in the background by `query_log_writer`. Pass a `stats` dict to receive
+    per-stage timings in milliseconds, the path that served the results (`served_by`), whether the query vector
+    was that of a similar cached query (`similar_query`) and why the search was degraded, if it was (`degraded`).
+
+    With `hybrid` a full-text search runs alongside and its ranking is fused with the vector ranking
+    (reciprocal rank fusion).
+
+    With `multi_interest` (default `SEARCH_MULTI_INTEREST`) the query is combined with each of the user's
+    interest centroids instead of their single taste vector, one search runs per interest and the results are
+    merged, so a user with distinct tastes is not served the shows in between them.
+
+    The search has a latency budget of `deadline_ms` (default `SEARCH_DEADLINE_MS`), split between the query
+    embedding and the vector search. When the embedding fails, overruns its share or the embeddings circuit
+    is open, the embedding of a near-identical cached query is used instead. Without one, or when the vector
+    search overruns, the full-text results are served, and when those are empty the user's stored recommendations.
+
+    Results are `MotnShow`s without their vector fields, or compact `ShowResult`s with `projection=True`.
+    """
+    started = time.perf_counter()
+    timings = {}
+    mode = mode or settings.SEARCH_MODE
+    hybrid = settings.SEARCH_HYBRID if hybrid is None else hybrid
+    multi_interest = settings.SEARCH_MULTI_INTEREST if multi_interest is None else multi_interest
+
+    budget = (settings.SEARCH_DEADLINE_MS if deadline_ms is None else deadline_ms) / 1000
+    deadline = started + budget
+    embed_deadline = started + budget * settings.SEARCH_EMBED_BUDGET_SHARE
+
+    def remaining(until: float = deadline) -> float:
+        return max(until - time.perf_counter(), 0.0)
+
     # structured = parse_user_query(raw_query)
     # embedding_query_text = structured.get("embedding_query_text") or raw_query
     embedding_query_text = raw_query
     structured = {}
 
-    # embed the structured query text
-    q_vec = embed_text(embedding_query_text)
-
-    u_vec = user_embedding
-    if u_vec is None and user is not None:
-        u_vec = get_user_embedding(user)
+    base_qs = build_base_queryset(structured)
 
-    if u_vec is not None:
-        q_vec = combine_query_and_user(q_vec, u_vec, alpha=alpha)
+    # The local mode compares vectors of the local encoder with `embedding_local`
+    local = mode == "local"
+    embedding_field = "embedding_local" if local else "embedding"
 
-    base_qs = build_base_queryset(structured)
+    # embed the structured query text, in the background while the user vector is loaded
+    embed_fn = embed_text_local if local else embed_text
+    q_future = run_in_thread(_timed, timings, "embed_query", embed_fn, embedding_query_text)
 
-    # Use q_vec (combined or just query) for the distance search
-    # Execute query and convert to list to cache results and get IDs
-    results = list(
-        base_qs.exclude(embedding__isnull=True)
-        .annotate(distance=CosineDistance("embedding", q_vec))
-        .order_by("distance")[:top_k]
-    )
+    # The lexical leg needs no embedding, it runs from the start
+    candidates = max(top_k, settings.SEARCH_HYBRID_CANDIDATES)
+    lexical_future = None
+    if hybrid:
+        lexical_future = run_in_thread(
+            _timed, timings, "lexical_search", lexical_search_ids, raw_query, candidates, queryset=base_qs
+        )
 
-    # Log the query for analytics
+    # One user vector, or one per interest; interests are only clustered on the OpenAI embeddings
+    u_vecs = None if user_embedding is None else [user_embedding]
+    if u_vecs is None and user is not None:
+        if multi_interest and not local:
+            centroids = _timed(timings, "user_embedding", get_interest_centroids, user)
+            u_vecs = centroids and [vector for vector, _ in centroids]
+        else:
+            u_vec = _timed(timings, "user_embedding", get_user_embedding, user, field=embedding_field)
+            u_vecs = u_vec and [u_vec]
+
+    degraded = None
+    served_by = "hybrid" if hybrid else "vector"
+    # The fallback query vector still goes through the vector (or hybrid) path, it is reported separately
+    similar_query = False
     try:
-        from .models import UserQueryLog
-        from django.contrib.auth import get_user_model
-        
-        # Ensure user is a model instance or None (if it's an ID or SimpleLazyObject handle appropriately)
-        log_user = user if (user and user.is_authenticated) else None
-        
-        # Extract IDs
-        result_ids = [r.id for r in results]
-        
-        UserQueryLog.objects.create(
-            user=log_user,
-            query=raw_query,
-            top_k=top_k,
-            result_ids=result_ids,
-            result_metadata_dump={"structured": structured, "alpha": alpha},
+        q_vec = q_future.result(timeout=remaining(embed_deadline))
+    except TimeoutError:
+        q_vec, degraded = None, "embedding_timeout"
+    except CircuitOpenError:
+        q_vec, degraded = None, "embedding_circuit_open"
+    except OpenAIError:
+        q_vec, degraded = None, "embedding_error"
+        logger.warning("Query embedding failed", exc_info=True)
+
+    if "embed_query" in timings and "user_embedding" in timings:
+        # Latency hidden by running both stages side by side
+        overlap = timings["embed_query"] + timings["user_embedding"] - (time.perf_counter() - started) * 1000
+        timings["saved_by_overlap"] = round(max(overlap, 0.0), 2)
+
+    if q_vec is None and not local:
+        similar = _timed(
+            timings,
+            "similar_query",
+            query_embedding_cache.get_similar,
+            settings.OPENAI_EMBEDDING_MODEL,
+            embedding_query_text,
+        )
+        if similar is not None:
+            q_vec = similar.tolist()
+            similar_query = True
+
+    # Use the query vectors (combined or just query) for the distance search
+    q_vecs = None
+    if q_vec is not None:
+        q_vecs = [combine_query_and_user(q_vec, u_vec, alpha=alpha) for u_vec in u_vecs] if u_vecs else [q_vec]
+
+    # Execute query and convert to list to cache results and get IDs
+    search_backend = get_search_backend(backend, mode=mode)
+    results = None
+    if q_vecs is not None:
+        try:
+            if len(q_vecs) > 1 and not hybrid:
+                hits = _timed(
+                    timings,
+                    "vector_search",
+                    search_ids_per_interest,
+                    search_backend,
+                    q_vecs,
+                    top_k,
+                    queryset=base_qs,
+                    ef_search=ef_search,
+                    mode=mode,
+                    candidate_multiplier=candidate_multiplier,
+                    timeout=remaining(),
+                )
+                results = fetch_shows(hits, projection=projection)
+            elif not hybrid:
+                results = _timed(
+                    timings,
+                    "vector_search",
+                    search_backend.search,
+                    q_vecs[0],
+                    top_k,
+                    queryset=base_qs,
+                    ef_search=ef_search,
+                    mode=mode,
+                    candidate_multiplier=candidate_multiplier,
+                    projection=projection,
+                    timeout=remaining(),
+                )
+            else:
+                vector_hits = _timed(
+                    timings,
+                    "vector_search",
+                    search_ids_per_interest,
+                    search_backend,
+                    q_vecs,
+                    candidates,
+                    queryset=base_qs,
+                    ef_search=ef_search,
+                    mode=mode,
+                    candidate_multiplier=candidate_multiplier,
+                    timeout=remaining(),
+                )
+                try:
+                    lexical_hits = lexical_future.result(timeout=remaining())
+                except TimeoutError:
+                    lexical_hits, degraded = [], "lexical_timeout"
+                fused = reciprocal_rank_fusion(vector_hits, lexical_hits)[:top_k]
+                # Shows found by the full-text leg only have no distance
+                distances = dict(vector_hits)
+                results = fetch_shows([(show_id, distances.get(show_id)) for show_id in fused], projection=projection)
+        except SearchTimeout:
+            degraded = "search_timeout"
+
+    if results is None:
+        # Degraded: no usable query vector or the vector search overran the budget
+        logger.warning("Serving degraded search results (%s)", degraded)
+        if lexical_future is None:
+            lexical_future = run_in_thread(
+                _timed, timings, "lexical_search", lexical_search_ids, raw_query, top_k, queryset=base_qs
+            )
+        try:
+            lexical_hits = lexical_future.result(timeout=max(remaining(), settings.SEARCH_FALLBACK_BUDGET_MS / 1000))
+        except TimeoutError:
+            lexical_hits = []
+
+        hits = [(show_id, None) for show_id, _ in lexical_hits[:top_k]]
+        served_by = "lexical"
+        if not hits:
+            hits = _timed(timings, "stored_recommendations", _stored_recommendation_hits, user, top_k)
+            served_by = "recommendations" if hits else "none"
+        results = fetch_shows(hits, projection=projection)
+
+    # Log the query for analytics, off the critical path
+    metadata = {
+        "structured": structured,
+        "alpha": alpha,
+        "mode": mode,
+        "interests": len(u_vecs) if u_vecs else 0,
+        "served_by": served_by,
+        "similar_query": similar_query,
+        "degraded": degraded,
+    }
+    _log_query(user, raw_query, top_k, [r.id for r in results], metadata)
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+    if stats is not None:
+        stats.update(
+            {
+                "backend": search_backend.name,
+                "mode": mode,
+                "served_by": served_by,
+                "similar_query": similar_query,
+                "degraded": degraded,
+                "timings": timings,
+            }
         )
-    except Exception as e:
-        print(f"Error logging query: {e}")
 
     return results, structured
 
 
+def search_shows_many(
+    queries: list[str],
+    top_k: int = 20,
+    alpha: float = 0.5,
+    user_embeddings: list | None = None,
+    backend: str | None = None,
+    mode: str | None = None,
+    projection: bool = False,
+) -> list[list]:
+    """
+    Search many queries at once, for offline evaluation runs.
+
+    All queries are embedded with batched embeddings requests and scored together by the backend
+    (one SQL statement with a LATERAL top-k, or one matrix-matrix product for the NumPy backend).
+    `user_embeddings`, when given, holds an optional taste vector per query.
+    These searches are not written to the query log.
+
+    Returns the results per query, in the same order as `queries`.
+    """
+    mode = mode or settings.SEARCH_MODE
+    if mode == "local":
+        q_vecs = local_encoder.encode(queries).tolist()
+    else:
+        q_vecs = embed_texts(queries)
+
+    if user_embeddings is not None:
+        q_vecs = [
+            q_vec if u_vec is None else combine_query_and_user(q_vec, u_vec, alpha=alpha)
+            for q_vec, u_vec in zip(q_vecs, user_embeddings, strict=True)
+        ]
+
+    search_backend = get_search_backend(backend, mode=mode)
+    hits = search_backend.search_ids_many(q_vecs, top_k, mode=mode)
+    return fetch_shows_many(hits, projection=projection)
+
+
 def update_user_recommendations(user):
     """
     Recalculates recommendations for the user based solely on their interactions.
@@ -188,30 +545,28 @@ def update_user_recommendations(user):
     if not user.is_authenticated:
         return
 
-    # 1. Get user embedding based on interactions
-    u_vec = get_user_embedding(user)
-    
-    if not u_vec:
+    # 1. Get user embedding based on interactions, or one per interest
+    if settings.SEARCH_MULTI_INTEREST:
+        centroids = get_interest_centroids(user)
+        u_vecs = centroids and [vector for vector, _ in centroids]
+    else:
+        u_vec = get_user_embedding(user)
+        u_vecs = u_vec and [u_vec]
+
+    if not u_vecs:
         # If no embedding (e.g. no history), clear recommendations
-        UserRecommendation.objects.update_or_create(
-             user=user,
-             defaults={'recommended_shows': []}
-        )
+        UserRecommendation.objects.update_or_create(user=user, defaults={"recommended_shows": []})
         return
 
     # 2. Find shows similar to this embedding
     # Exclude shows the user has already interacted with
-    watched_ids = UserViewInteraction.objects.filter(user=user).values_list('show_id', flat=True)
-    
-    qs = MotnShow.objects.exclude(id__in=watched_ids).exclude(embedding__isnull=True)
-    
-    # We use the user vector directly for similarity search
-    qs = qs.annotate(distance=CosineDistance("embedding", u_vec)).order_by("distance")[:50]
-    
-    recommended_ids = list(qs.values_list('id', flat=True))
-    
-    # 3. Save to UserRecommendation
-    UserRecommendation.objects.update_or_create(
-        user=user,
-        defaults={'recommended_shows': recommended_ids}
+    watched_ids = UserViewInteraction.objects.filter(user=user).values_list("show_id", flat=True)
+
+    # We use the user vectors directly for similarity search
+    hits = search_ids_per_interest(
+        get_search_backend(), u_vecs, settings.RECOMMENDATIONS_TOP_K, exclude_ids=watched_ids
     )
+    recommended_ids = [show_id for show_id, _ in hits]
+
+    # 3. Save to UserRecommendation
+    UserRecommendation.objects.update_or_create(user=user, defaults={"recommended_shows": recommended_ids})
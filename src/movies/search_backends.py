@@ -0,0 +1,474 @@
+"""
+Vector search backends for `MotnShow.embedding`.
+
+- `pgvector`: distance ordering in Postgres, served by the HNSW index.
+- `numpy`: all embeddings loaded once into a contiguous in-process matrix, top-k with one matrix-vector product.
+
+The backend is selected with `settings.SEARCH_BACKEND`, use `get_search_backend()` to get the shared instance.
+"""
+
+import copy
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import Count, Max
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast
+from pgvector import Vector
+from pgvector.django import CosineDistance, HalfVectorField, HammingDistance
+from psycopg2.errors import QueryCanceled
+
+from misc.utils.embedding import binary_quantize, truncate_embedding
+
+from .models import MotnShow
+
+# Never loaded with search results, vectors and the full-text document are only compared inside the database
+HEAVY_FIELDS = ("embedding", "embedding_short", "embedding_bit", "embedding_local", "search_document")
+# Columns selected for `ShowResult`
+DISPLAY_FIELDS = (
+    "id",
+    "title",
+    "year",
+    "show_type",
+    "age_certification",
+    "imdb_rating",
+    "tmdb_rating",
+    "original_language",
+    "overview",
+)
+
+
+class ShowResult:
+    """
+    Compact search result with only the fields the result list displays, see `project_shows()`.
+
+    Roughly 1 KB per result instead of a full `MotnShow` with its vectors and JSON columns.
+    """
+
+    __slots__ = (*DISPLAY_FIELDS, "poster_url", "watch_link", "distance")
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values, strict=True):
+            setattr(self, name, value)
+
+    def __str__(self) -> str:
+        # Same as MotnShow.__str__, benchmarks compare results by their string
+        return f"{self.title} ({self.year or 'n/a'})"
+
+    def __repr__(self):
+        return f"<{self.id}: {self}>"
+
+
+def project_shows(queryset, limit: int | None = None) -> list[ShowResult]:
+    """
+    Return `ShowResult`s for a (possibly distance-annotated and ordered) `MotnShow` queryset.
+
+    Only the display fields are selected, the poster URL and Netflix NL link are extracted from their JSON in SQL.
+    """
+    has_distance = "distance" in queryset.query.annotations
+    rows = queryset.annotate(
+        poster_url=KT("poster_urls__w240"),
+        watch_link=KT("streaming_options__nl__0__videoLink"),
+    ).values_list(*DISPLAY_FIELDS, "poster_url", "watch_link", *(["distance"] if has_distance else []))
+    if limit is not None:
+        rows = rows[:limit]
+
+    if has_distance:
+        return [ShowResult(*row) for row in rows]
+    return [ShowResult(*row, None) for row in rows]
+
+
+def fetch_shows(hits: list[tuple[int, float | None]], projection: bool = False):
+    """Load shows for `(show_id, distance)` pairs, keeping their order, shows that no longer exist are skipped."""
+    show_ids = [show_id for show_id, _ in hits]
+    if projection:
+        shows = {show.id: show for show in project_shows(MotnShow.objects.filter(id__in=show_ids))}
+    else:
+        shows = MotnShow.objects.defer(*HEAVY_FIELDS).in_bulk(show_ids)
+
+    results = []
+    for show_id, distance in hits:
+        show = shows.get(show_id)
+        if show is None:  # deleted since the matrix was loaded
+            continue
+        show.distance = distance
+        results.append(show)
+    return results
+
+
+def fetch_shows_many(hits_per_query: list[list[tuple[int, float]]], projection: bool = False):
+    """Like `fetch_shows()` for the results of many queries, all shows are loaded with one query."""
+    unique = {show_id: None for hits in hits_per_query for show_id, _ in hits}
+    shows = {show.id: show for show in fetch_shows(list(unique.items()), projection=projection)}
+
+    results = []
+    for hits in hits_per_query:
+        query_results = []
+        for show_id, distance in hits:
+            if show_id not in shows:
+                continue
+            # A show can be a hit for several queries, each with its own distance
+            show = copy.copy(shows[show_id])
+            show.distance = distance
+            query_results.append(show)
+        results.append(query_results)
+    return results
+
+
+class SearchTimeout(Exception):
+    """The search did not finish within its time budget."""
+
+
+def embedding_distance(vector):
+    """
+    Cosine distance between `MotnShow.embedding` and `vector`.
+
+    The embedding is cast to halfvec so the expression matches the HNSW index `motnshow_embedding_hnsw`,
+    ordering by this annotation (with a LIMIT) lets the planner do an index scan instead of a sequential scan.
+    """
+    return CosineDistance(Cast("embedding", HalfVectorField(dimensions=settings.OPENAI_EMBEDDING_DIM)), vector)
+
+
+@contextmanager
+def hnsw_search(top_k: int, ef_search: int | None = None, timeout: float | None = None):
+    """
+    Scope HNSW search parameters to the queries executed inside this block.
+
+    An HNSW scan returns at most `ef_search` rows, so it is raised to `top_k` when more results are requested.
+    Queries running longer than `timeout` seconds are cancelled by Postgres and raise `SearchTimeout`.
+    """
+    ef_search = min(max(ef_search or settings.VECTOR_SEARCH_HNSW_EF_SEARCH, top_k), 1000)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # SET LOCAL only lasts until the end of the transaction
+        cursor.execute("SET LOCAL hnsw.ef_search = %s", [ef_search])
+        if settings.VECTOR_SEARCH_HNSW_ITERATIVE_SCAN:
+            cursor.execute("SET LOCAL hnsw.iterative_scan = %s", [settings.VECTOR_SEARCH_HNSW_ITERATIVE_SCAN])
+        try:
+            if timeout is not None:
+                # 0 would disable the timeout
+                cursor.execute("SET LOCAL statement_timeout = %s", [max(int(timeout * 1000), 1)])
+            yield
+        except OperationalError as exc:
+            if isinstance(exc.__cause__, QueryCanceled):
+                raise SearchTimeout from exc
+            raise
+
+
+class SearchBackend:
+    name = None
+
+    def search_ids(self, q_vec, top_k: int, queryset=None, exclude_ids=None, **options) -> list[tuple[int, float]]:
+        """
+        Return `(show_id, cosine_distance)` pairs for the `top_k` nearest shows, nearest first.
+
+        Backend specific `options` (e.g. `ef_search`, or a `timeout` in seconds after which `SearchTimeout`
+        is raised) are ignored by backends that do not use them.
+        """
+        raise NotImplementedError
+
+    def search(
+        self, q_vec, top_k: int, queryset=None, exclude_ids=None, projection: bool = False, **options
+    ) -> list[MotnShow] | list[ShowResult]:
+        """
+        Return the `top_k` nearest shows, nearest first, with the distance set as `show.distance`.
+
+        With `projection` the results are `ShowResult`s, otherwise `MotnShow`s without their vector fields.
+        """
+        hits = self.search_ids(q_vec, top_k, queryset=queryset, exclude_ids=exclude_ids, **options)
+        return fetch_shows(hits, projection=projection)
+
+    def search_ids_many(self, q_vecs, top_k: int, exclude_ids=None, **options) -> list[list[tuple[int, float]]]:
+        """Run `search_ids()` for every query vector, backends override this to score all queries at once."""
+        return [self.search_ids(q_vec, top_k, exclude_ids=exclude_ids, **options) for q_vec in q_vecs]
+
+    def reload(self):
+        """Drop any state derived from the stored embeddings."""
+
+
+class PgvectorSearchBackend(SearchBackend):
+    """
+    Search in Postgres, the first stage of every mode is served by an HNSW index.
+
+    Modes:
+    - `vector`: order by the halfvec cast of the full embedding.
+    - `matryoshka`: shortlist `top_k * candidate_multiplier` shows on `embedding_short`,
+      then rerank only those with the exact distance on the full embedding.
+    - `binary`: same two stages, but shortlisted by Hamming distance on the sign-quantised `embedding_bit`.
+    - `local`: order by `embedding_local`, for query vectors of the local encoder (`movies.local_encoder`).
+    """
+
+    name = "pgvector"
+    modes = ("vector", "matryoshka", "binary", "local")
+
+    def _queryset(self, q_vec, top_k, queryset=None, exclude_ids=None, mode="vector", candidate_multiplier=None):
+        """Return the ordered queryset and the number of rows the HNSW scan has to produce."""
+        qs = MotnShow.objects.all() if queryset is None else queryset
+        if exclude_ids:
+            qs = qs.exclude(id__in=exclude_ids)
+
+        if mode == "local":
+            qs = qs.exclude(embedding_local__isnull=True)
+            return qs.annotate(distance=CosineDistance("embedding_local", q_vec)).order_by("distance"), top_k
+
+        qs = qs.exclude(embedding__isnull=True)
+        if mode == "vector":
+            return qs.annotate(distance=embedding_distance(q_vec)).order_by("distance"), top_k
+
+        if mode in ("matryoshka", "binary"):
+            candidates = top_k * (candidate_multiplier or settings.SEARCH_CANDIDATE_MULTIPLIER)
+            if mode == "matryoshka":
+                first_stage = CosineDistance("embedding_short", truncate_embedding(q_vec, settings.EMBEDDING_SHORT_DIM))
+            else:
+                first_stage = HammingDistance("embedding_bit", binary_quantize(q_vec))
+            shortlist = (
+                qs.annotate(first_stage_distance=first_stage).order_by("first_stage_distance").values("id")[:candidates]
+            )
+            # Only the shortlisted rows are compared with the full 3072-dim vector
+            reranked = MotnShow.objects.filter(id__in=shortlist).annotate(distance=CosineDistance("embedding", q_vec))
+            return reranked.order_by("distance"), candidates
+
+        raise ValueError(f"Unknown search mode for {self.name} backend: {mode}")
+
+    def search_ids(
+        self,
+        q_vec,
+        top_k: int,
+        queryset=None,
+        exclude_ids=None,
+        ef_search: int | None = None,
+        timeout: float | None = None,
+        **options,
+    ):
+        qs, scan_size = self._queryset(q_vec, top_k, queryset, exclude_ids, **options)
+        with hnsw_search(scan_size, ef_search, timeout):
+            return list(qs.values_list("id", "distance")[:top_k])
+
+    def search_ids_many(
+        self, q_vecs, top_k: int, exclude_ids=None, ef_search: int | None = None, mode="vector", **options
+    ):
+        if mode != "vector":
+            return super().search_ids_many(q_vecs, top_k, exclude_ids=exclude_ids, ef_search=ef_search, mode=mode)
+        if not q_vecs:
+            return []
+
+        # One statement for all queries: a LATERAL top-k per query vector, each served by the HNSW index.
+        # The ORDER BY expression must match the index expression (see `embedding_distance`).
+        table = connection.ops.quote_name(MotnShow._meta.db_table)
+        halfvec = f"halfvec({settings.OPENAI_EMBEDDING_DIM})"
+        exclude_sql = "AND NOT (m.id = ANY(%s))" if exclude_ids else ""
+        sql = f"""
+            SELECT q.ord, s.id, s.distance
+            FROM unnest(%s::text[]) WITH ORDINALITY AS q(vec, ord)
+            CROSS JOIN LATERAL (
+                SELECT m.id, (m.embedding::{halfvec} <=> q.vec::{halfvec}) AS distance
+                FROM {table} m
+                WHERE m.embedding IS NOT NULL {exclude_sql}
+                ORDER BY m.embedding::{halfvec} <=> q.vec::{halfvec}
+                LIMIT %s
+            ) s
+            ORDER BY q.ord, s.distance
+        """
+        params = [[Vector(q_vec).to_text() for q_vec in q_vecs]]
+        if exclude_ids:
+            params.append(list(exclude_ids))
+        params.append(top_k)
+
+        hits = [[] for _ in q_vecs]
+        with hnsw_search(top_k, ef_search), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for ord_, show_id, distance in cursor.fetchall():
+                hits[ord_ - 1].append((show_id, distance))
+        return hits
+
+    def search(
+        self,
+        q_vec,
+        top_k: int,
+        queryset=None,
+        exclude_ids=None,
+        projection: bool = False,
+        ef_search: int | None = None,
+        timeout: float | None = None,
+        **options,
+    ):
+        # Single query, no need to hydrate the rows afterwards
+        qs, scan_size = self._queryset(q_vec, top_k, queryset, exclude_ids, **options)
+        with hnsw_search(scan_size, ef_search, timeout):
+            if projection:
+                return project_shows(qs, limit=top_k)
+            return list(qs.defer(*HEAVY_FIELDS)[:top_k])
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Column indices of the `top_k` highest scores per row, highest first."""
+    top_k = min(top_k, scores.shape[1])
+    if top_k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    idx = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1)
+
+
+class NumpySearchBackend(SearchBackend):
+    """
+    Exact cosine search over an in-process copy of all show embeddings.
+
+    Every search is already exact, so the approximate modes of the pgvector backend are answered the same way.
+    The rows are L2-normalised when loaded so a dot product equals the cosine similarity.
+    The matrix is reloaded when `reload()` is called or when the embedded rows in the database
+    changed, which is checked at most every `SEARCH_NUMPY_REFRESH_INTERVAL` seconds.
+    """
+
+    name = "numpy"
+    modes = ("vector", "matryoshka", "binary")
+    QUERY_BLOCK_SIZE = 256
+
+    def __init__(self, dtype: str | None = None, refresh_interval: float | None = None):
+        self.dtype = np.dtype(dtype or settings.SEARCH_NUMPY_DTYPE)
+        self.refresh_interval = settings.SEARCH_NUMPY_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self._lock = threading.Lock()
+        # (ids, matrix): sorted int64 show ids and their (n, d) normalised embeddings, row i belongs to ids[i]
+        self._data = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+
+    @staticmethod
+    def _current_fingerprint():
+        return tuple(
+            MotnShow.objects.exclude(embedding__isnull=True)
+            .aggregate(count=Count("id"), max_id=Max("id"), updated_at=Max("updated_at"))
+            .values()
+        )
+
+    def _load(self):
+        fingerprint = self._current_fingerprint()
+        rows = MotnShow.objects.exclude(embedding__isnull=True).order_by("id").values_list("id", "embedding")
+
+        # Preallocate and fill per row, avoids holding a list of per-row arrays next to the matrix
+        total = fingerprint[0]
+        ids = np.empty(total, dtype=np.int64)
+        matrix = np.empty((total, settings.OPENAI_EMBEDDING_DIM), dtype=self.dtype)
+        n = 0
+        for show_id, embedding in rows.iterator(chunk_size=2000):
+            if n == total:  # rows added while loading, picked up by the next refresh
+                break
+            ids[n] = show_id
+            matrix[n] = embedding
+            n += 1
+        ids, matrix = ids[:n], matrix[:n]
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True).astype(self.dtype)
+        norms[norms == 0] = 1
+        matrix /= norms
+
+        # Swap both at once, searches running on the old matrix keep their reference
+        self._data = (ids, np.ascontiguousarray(matrix))
+        self._fingerprint = fingerprint
+        self._checked_at = time.monotonic()
+
+    def reload(self):
+        with self._lock:
+            self._load()
+
+    def refresh_if_stale(self):
+        """Reload when not loaded yet, or when the stored embeddings changed since the last load."""
+        if self._data is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+
+        with self._lock:
+            if self._data is None:
+                self._load()
+                return
+            if time.monotonic() - self._checked_at < self.refresh_interval:
+                return  # another thread just checked
+            self._checked_at = time.monotonic()
+            if self._current_fingerprint() != self._fingerprint:
+                self._load()
+
+    def snapshot(self):
+        """Return the current `(ids, matrix)` pair, loading it if needed."""
+        self.refresh_if_stale()
+        return self._data
+
+    @staticmethod
+    def _rows_for(ids, show_ids):
+        """Matrix rows of the given show ids, ids that are not loaded are skipped."""
+        show_ids = np.fromiter(show_ids, dtype=np.int64)
+        if not len(ids) or not len(show_ids):
+            return np.empty(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(ids, show_ids), len(ids) - 1)
+        return rows[ids[rows] == show_ids]
+
+    def _query_matrix(self, q_vecs):
+        """(m, d) L2-normalised query vectors in the matrix dtype."""
+        q = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        norms = np.linalg.norm(q, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return (q / norms).astype(self.dtype)
+
+    def search_ids(self, q_vec, top_k: int, queryset=None, exclude_ids=None, **options):
+        return self.search_ids_many([q_vec], top_k, queryset=queryset, exclude_ids=exclude_ids, **options)[0]
+
+    def search_ids_many(self, q_vecs, top_k: int, queryset=None, exclude_ids=None, mode="vector", **options):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown search mode for {self.name} backend: {mode}")
+        if not len(q_vecs):
+            return []
+
+        ids, matrix = self.snapshot()
+
+        excluded = np.zeros(len(ids), dtype=bool)
+        if queryset is not None and queryset.query.has_filters():
+            excluded[:] = True
+            excluded[self._rows_for(ids, queryset.values_list("id", flat=True))] = False
+        if exclude_ids:
+            excluded[self._rows_for(ids, exclude_ids)] = True
+
+        hits = []
+        # Blocks of queries bound the size of the (queries, shows) score matrix
+        for start in range(0, len(q_vecs), self.QUERY_BLOCK_SIZE):
+            q = self._query_matrix(q_vecs[start : start + self.QUERY_BLOCK_SIZE])
+            scores = (q @ matrix.T).astype(np.float32)
+            scores[:, excluded] = -np.inf
+
+            for row, top in zip(scores, top_k_indices(scores, top_k), strict=True):
+                top = top[np.isfinite(row[top])]
+                hits.append([(int(ids[i]), float(1 - row[i])) for i in top])
+        return hits
+
+
+BACKENDS = {
+    PgvectorSearchBackend.name: PgvectorSearchBackend,
+    NumpySearchBackend.name: NumpySearchBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_search_backend(name: str | None = None, mode: str | None = None) -> SearchBackend:
+    """
+    Return the process-wide backend instance, shared between Streamlit sessions.
+
+    When a `mode` is given that the backend does not support (the NumPy backend holds no `embedding_local`
+    matrix), the pgvector backend is returned instead.
+    """
+    name = name or settings.SEARCH_BACKEND
+    if mode is not None and mode not in BACKENDS[name].modes:
+        name = PgvectorSearchBackend.name
+    if name not in _backends:
+        with _backends_lock:
+            if name not in _backends:
+                _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def reload_search_backends():
+    """Reload all instantiated backends, e.g. after new embeddings were written in this process."""
+    for backend in list(_backends.values()):
+        backend.reload()
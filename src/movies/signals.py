@@ -0,0 +1,38 @@
+"""
+Keep `UserTasteProfile`s up to date when interactions are created, re-rated or deleted.
+
+Only `save()` and `delete()` send these signals, `QuerySet.update()` and `bulk_create()` bypass them.
+"""
+
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import UserViewInteraction
+from .taste_profile import interaction_weight, update_taste_profile
+
+
+@receiver(post_init, sender=UserViewInteraction)
+def remember_rating(sender, instance, **kwargs):
+    # The rating as stored, to apply only the difference when it changes
+    if "rating" not in instance.get_deferred_fields():
+        instance._stored_rating = instance.rating if instance.pk else None
+
+
+@receiver(post_save, sender=UserViewInteraction)
+def add_to_taste_profile(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    stored_rating = getattr(instance, "_stored_rating", None)
+    if created:
+        update_taste_profile(instance.user_id, instance.show_id, interaction_weight(instance.rating), 1)
+    elif stored_rating is not None and stored_rating != instance.rating:
+        weight_delta = interaction_weight(instance.rating) - interaction_weight(stored_rating)
+        update_taste_profile(instance.user_id, instance.show_id, weight_delta, 0)
+    instance._stored_rating = instance.rating
+
+
+@receiver(post_delete, sender=UserViewInteraction)
+def remove_from_taste_profile(sender, instance, **kwargs):
+    # No profile to create while the user itself may be being deleted
+    update_taste_profile(instance.user_id, instance.show_id, -interaction_weight(instance.rating), -1, create=False)
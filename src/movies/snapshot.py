@@ -0,0 +1,296 @@
+"""
+Catalog snapshots: `MotnShow` rows with their genres and vectors, to bootstrap a database in seconds instead of
+running `import_streaming_availability` and `build_embeddings`.
+
+A snapshot is a directory of
+- `shows.jsonl.gz`: one JSON object per show with its columns (including the embedded texts' hashes) and genres,
+- `<field>.npy` and `<field>.ids.npy` per vector field: a float32 matrix of the non-null vectors and their show ids,
+- `manifest.json`, written last, with the counts and dimensions.
+
+Both directions stream through `COPY` without building a Python object per row: the JSON is produced and parsed
+by PostgreSQL (`to_jsonb` / `jsonb_populate_record`), vectors use the binary COPY format of `movies.vector_writer`.
+The export runs in one REPEATABLE READ transaction, so the files are a consistent snapshot of a live database.
+"""
+
+import gzip
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.utils import timezone
+from pgvector.django import VectorField
+
+from .models import MotnGenre, MotnShow, MotnShowGenre, UserViewInteraction
+from .taste_profile import rebuild_taste_profiles
+from .vector_writer import COPY_HEADER, copy_data
+
+SNAPSHOT_FORMAT = 1
+# Rows per COPY of vectors when importing, 10k text-embedding-3-large vectors are 120 MB
+VECTOR_COPY_ROWS = 10_000
+# Users whose taste profiles are rebuilt per query after an import changed the vectors of their shows
+TASTE_PROFILE_REBUILD_CHUNK = 500
+# Every line is a JSON document, whose text never contains these control characters: CSV without quoting or escaping
+JSON_LINES_COPY = "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+
+
+def vector_fields() -> list[VectorField]:
+    return [field for field in MotnShow._meta.concrete_fields if isinstance(field, VectorField)]
+
+
+def show_columns() -> list[str]:
+    """Columns stored as JSON, generated and vector columns excluded."""
+    return [
+        field.column
+        for field in MotnShow._meta.concrete_fields
+        if not isinstance(field, (VectorField, models.GeneratedField))
+    ]
+
+
+class _VectorRows:
+    """File-like target of `COPY (SELECT id, vector ...) TO STDOUT (FORMAT binary)`, fills preallocated arrays."""
+
+    def __init__(self, ids: np.ndarray, values: np.ndarray):
+        self.ids = ids
+        self.values = values
+        dim = values.shape[1]
+        # Field count, id length, id, vector length, vector_send: int16 dimensions, int16 unused, big-endian float4s
+        self.row = np.dtype(
+            [("fields", ">i2"), ("id_size", ">i4"), ("id", ">i8"), ("size", ">i4"), ("dim", ">i2"), ("unused", ">i2")]
+            + [("values", ">f4", (dim,))]
+        )
+        self.buffer = bytearray()
+        self.header = True
+        self.count = 0
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if self.header:
+            # Signature, flags and the length of the header extension
+            if len(self.buffer) < len(COPY_HEADER):
+                return
+            (extension,) = struct.unpack(">i", self.buffer[len(COPY_HEADER) - 4 : len(COPY_HEADER)])
+            del self.buffer[: len(COPY_HEADER) + extension]
+            self.header = False
+
+        # The 2-byte trailer is shorter than a row and stays in the buffer
+        n = len(self.buffer) // self.row.itemsize
+        if not n:
+            return
+        rows = np.frombuffer(self.buffer, dtype=self.row, count=n)
+        self.ids[self.count : self.count + n] = rows["id"]
+        self.values[self.count : self.count + n] = rows["values"]
+        self.count += n
+        del rows
+        del self.buffer[: n * self.row.itemsize]
+
+
+def export_snapshot(path: Path, log=print) -> dict:
+    """Write a snapshot of the catalog to the directory `path`, returns its manifest."""
+    path.mkdir(parents=True, exist_ok=True)
+    quote = connection.ops.quote_name
+    table = quote(MotnShow._meta.db_table)
+    columns = show_columns()
+    excluded = [field.column for field in MotnShow._meta.concrete_fields if field.column not in columns]
+    manifest = {"format": SNAPSHOT_FORMAT, "created_at": timezone.now().isoformat(), "vectors": {}}
+
+    # Within an enclosing transaction (e.g. in tests) the export keeps its isolation level
+    outermost = not connection.in_atomic_block
+    with transaction.atomic(), connection.cursor() as cursor:
+        if outermost:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute(f"SELECT count(*) FROM {table}")
+        manifest["shows"] = cursor.fetchone()[0]
+
+        # Genre names in the order of their links, the embedded text lists them in that order
+        genres = (
+            f"SELECT coalesce(jsonb_agg(g.{quote('name')} ORDER BY sg.{quote('id')}), '[]') "
+            f"FROM {quote(MotnShowGenre._meta.db_table)} sg JOIN {quote(MotnGenre._meta.db_table)} g "
+            f"ON g.{quote('id')} = sg.{quote('genre_id')} WHERE sg.{quote('show_id')} = s.{quote('id')}"
+        )
+        removed = "".join(f" - '{column}'" for column in excluded)
+        with gzip.open(path / "shows.jsonl.gz", "wb") as fh:
+            cursor.copy_expert(
+                f"COPY (SELECT to_jsonb(s){removed} || jsonb_build_object('genres', ({genres})) "
+                f"FROM {table} s ORDER BY s.{quote('id')}) TO STDOUT {JSON_LINES_COPY}",
+                fh,
+            )
+        log(f"Exported {manifest['shows']} shows")
+
+        for field in vector_fields():
+            column = quote(field.column)
+            cursor.execute(f"SELECT count(*) FROM {table} WHERE {column} IS NOT NULL")
+            (count,) = cursor.fetchone()
+            ids = np.lib.format.open_memmap(path / f"{field.name}.ids.npy", mode="w+", dtype="<i8", shape=(count,))
+            values = np.lib.format.open_memmap(
+                path / f"{field.name}.npy", mode="w+", dtype="<f4", shape=(count, field.dimensions)
+            )
+            rows = _VectorRows(ids, values)
+            cursor.copy_expert(
+                f"COPY (SELECT {quote('id')}, {column} FROM {table} WHERE {column} IS NOT NULL "
+                f"ORDER BY {quote('id')}) TO STDOUT WITH (FORMAT binary)",
+                rows,
+            )
+            if rows.count != count:
+                raise ValueError(f"Expected {count} vectors of {field.name}, read {rows.count}")
+            ids.flush()
+            values.flush()
+            del ids, values
+            manifest["vectors"][field.name] = {"rows": count, "dimensions": field.dimensions}
+            log(f"Exported {count} vectors of {field.name}")
+
+    (path / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def import_snapshot(path: Path, log=print) -> int:
+    """
+    Insert or update the shows of the snapshot in the directory `path`, returns their number.
+
+    Shows keep their ids, so the snapshot must come from a database of the same lineage (or be loaded into an
+    empty one): a show whose `motn_id` or `source_id` belongs to another id here is refused. Into an empty table
+    the vector indexes are built once after loading instead of row by row. The taste profiles of the users who
+    interacted with shows whose `embedding` changed are rebuilt afterwards. Rows keep the snapshot's `updated_at`,
+    unless the import changed their vectors.
+    """
+    manifest_file = path / "manifest.json"
+    if not manifest_file.is_file():
+        raise ValueError(f"{path} is not a complete snapshot, {manifest_file.name} is missing")
+    manifest = json.loads(manifest_file.read_text())
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format {manifest.get('format')}")
+    fields = {field.name: field for field in vector_fields()}
+    for name, info in manifest["vectors"].items():
+        if name not in fields or fields[name].dimensions != info["dimensions"]:
+            raise ValueError(f"{name} vectors of {info['dimensions']} dimensions do not fit this schema")
+
+    quote = connection.ops.quote_name
+    table = quote(MotnShow._meta.db_table)
+    show_genre_table = quote(MotnShowGenre._meta.db_table)
+    genre_table = quote(MotnGenre._meta.db_table)
+    snapshot_id = "(s.doc ->> 'id')::bigint"
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        dropped = []
+        if not MotnShow.objects.exists():
+            cursor.execute(
+                "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+                "AND (indexdef LIKE '%%USING hnsw%%' OR indexdef LIKE '%%USING gin%%')",
+                [MotnShow._meta.db_table],
+            )
+            dropped = cursor.fetchall()
+            for name, _ in dropped:
+                cursor.execute(f"DROP INDEX {quote(name)}")
+
+        cursor.execute(f"CREATE TEMPORARY TABLE {quote('_snapshot_shows')} (doc jsonb) ON COMMIT DROP")
+        with gzip.open(path / "shows.jsonl.gz", "rb") as fh:
+            cursor.copy_expert(f"COPY {quote('_snapshot_shows')} (doc) FROM STDIN {JSON_LINES_COPY}", fh)
+        log(f"Loaded {manifest['shows']} shows")
+
+        # Rows are matched by id only, the other unique columns must agree with it
+        cursor.execute(
+            f"SELECT count(*) OVER (), {snapshot_id}, t.{quote('id')}, "
+            f"CASE WHEN t.{quote('motn_id')} = s.doc ->> 'motn_id' THEN 'motn_id ' || t.{quote('motn_id')} "
+            f"ELSE 'source_id ' || t.{quote('source_id')} END "
+            f"FROM {quote('_snapshot_shows')} s JOIN {table} t ON t.{quote('id')} <> {snapshot_id} "
+            f"AND (t.{quote('motn_id')} = s.doc ->> 'motn_id' "
+            f"OR t.{quote('source_id')} = (s.doc ->> 'source_id')::bigint) LIMIT 1"
+        )
+        if conflict := cursor.fetchone():
+            count, show_id, other_id, shared = conflict
+            raise ValueError(
+                f"{count} shows of the snapshot have the motn_id or source_id of another show in this database "
+                f"(e.g. show {show_id} and show {other_id} with {shared}), it comes from a database of another lineage"
+            )
+
+        joins, columns, values = [], show_columns(), [f"r.{quote(column)}" for column in show_columns()]
+        for name in manifest["vectors"]:
+            field = fields[name]
+            temp_table = quote(f"_snapshot_{field.column}")
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {temp_table} ({quote('id')} bigint, "
+                f"{quote('vector_value')} {field.db_type(connection)}) ON COMMIT DROP"
+            )
+            ids = np.load(path / f"{name}.ids.npy", mmap_mode="r")
+            vectors = np.load(path / f"{name}.npy", mmap_mode="r")
+            for start in range(0, len(ids), VECTOR_COPY_ROWS):
+                cursor.copy_expert(
+                    f"COPY {temp_table} FROM STDIN WITH (FORMAT binary)",
+                    copy_data(ids[start : start + VECTOR_COPY_ROWS], vectors[start : start + VECTOR_COPY_ROWS]),
+                )
+            joins.append(f"LEFT JOIN {temp_table} ON {temp_table}.{quote('id')} = r.{quote('id')}")
+            columns.append(field.column)
+            values.append(f"{temp_table}.{quote('vector_value')}")
+            log(f"Loaded {len(ids)} vectors of {name}")
+
+        # Taste profiles sum the embeddings of the users' shows, find the users before the vectors are replaced
+        user_ids = []
+        if "embedding" in manifest["vectors"]:
+            embedding = quote(fields["embedding"].column)
+            temp_table = quote(f"_snapshot_{fields['embedding'].column}")
+            cursor.execute(
+                f"SELECT DISTINCT i.{quote('user_id')} FROM {quote(UserViewInteraction._meta.db_table)} i "
+                f"JOIN {quote('_snapshot_shows')} s ON {snapshot_id} = i.{quote('show_id')} "
+                f"JOIN {table} t ON t.{quote('id')} = i.{quote('show_id')} "
+                f"LEFT JOIN {temp_table} v ON v.{quote('id')} = t.{quote('id')} "
+                f"WHERE t.{embedding} IS DISTINCT FROM v.{quote('vector_value')}"
+            )
+            user_ids = [user_id for (user_id,) in cursor.fetchall()]
+
+        # Every row is written once, with its vectors, so generated columns and indexes are computed once
+        assignments = [f"{quote(column)} = EXCLUDED.{quote(column)}" for column in columns if column != "id"]
+        # The in-process search backend notices changed vectors by max(updated_at), the snapshot's may be older
+        updated_at = quote(MotnShow._meta.get_field("updated_at").column)
+        vectors_changed = " OR ".join(
+            f"{table}.{quote(fields[name].column)} IS DISTINCT FROM EXCLUDED.{quote(fields[name].column)}"
+            for name in manifest["vectors"]
+        )
+        if vectors_changed:
+            assignments.remove(f"{updated_at} = EXCLUDED.{updated_at}")
+            assignments.append(
+                f"{updated_at} = CASE WHEN {vectors_changed} THEN statement_timestamp() ELSE EXCLUDED.{updated_at} END"
+            )
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(quote(column) for column in columns)}) "
+            f"SELECT {', '.join(values)} FROM {quote('_snapshot_shows')} s "
+            f"CROSS JOIN LATERAL jsonb_populate_record(NULL::{table}, s.doc) r {' '.join(joins)} "
+            f"ON CONFLICT ({quote('id')}) DO UPDATE SET {', '.join(assignments)}"
+        )
+        imported = cursor.rowcount
+
+        cursor.execute(
+            f"INSERT INTO {genre_table} ({quote('name')}) "
+            f"SELECT DISTINCT jsonb_array_elements_text(doc -> 'genres') FROM {quote('_snapshot_shows')} "
+            f"ON CONFLICT ({quote('name')}) DO NOTHING"
+        )
+        cursor.execute(
+            f"DELETE FROM {show_genre_table} WHERE {quote('show_id')} IN "
+            f"(SELECT {snapshot_id} FROM {quote('_snapshot_shows')} s)"
+        )
+        cursor.execute(
+            f"INSERT INTO {show_genre_table} ({quote('show_id')}, {quote('genre_id')}) "
+            f"SELECT {snapshot_id}, g.{quote('id')} FROM {quote('_snapshot_shows')} s "
+            f"CROSS JOIN LATERAL jsonb_array_elements_text(s.doc -> 'genres') WITH ORDINALITY AS n(name, position) "
+            f"JOIN {genre_table} g ON g.{quote('name')} = n.name "
+            f"ORDER BY {snapshot_id}, n.position"
+        )
+
+        # Ids were inserted explicitly, new rows must continue after them
+        for sql in connection.ops.sequence_reset_sql(no_style(), [MotnShow, MotnGenre, MotnShowGenre]):
+            cursor.execute(sql)
+
+        for name, definition in dropped:
+            log(f"Building index {name}")
+            cursor.execute(definition)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {table}")
+
+    # Also marks the interest centroids of these users for recomputation
+    for start in range(0, len(user_ids), TASTE_PROFILE_REBUILD_CHUNK):
+        rebuild_taste_profiles(user_ids[start : start + TASTE_PROFILE_REBUILD_CHUNK])
+    if user_ids:
+        log(f"Rebuilt {len(user_ids)} taste profiles")
+    return imported
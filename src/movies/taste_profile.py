@@ -0,0 +1,258 @@
+"""
+Incrementally maintained user taste vectors, see `UserTasteProfile`.
+
+A profile holds the rating-weighted sum of the embeddings of the shows a user interacted with, and the weights'
+total. Creating, re-rating or deleting an interaction adds the weighted show embedding (or the weight difference)
+to the sum, which costs O(d) instead of reloading every interaction. The sum is stored in float4, so every
+`TASTE_PROFILE_REBUILD_EVERY` updates it is recomputed from all interactions instead. The signal handlers in
+`movies.signals` call these functions, so interactions must be changed with `save()`/`delete()`, not
+`QuerySet.update()`.
+"""
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import MotnShow, UserInterestCentroid, UserTasteProfile, UserViewInteraction
+
+
+def interaction_weight(rating) -> float:
+    """Weight of an interaction in the taste vector."""
+    if rating == 2:  # way up
+        return 3.0
+    if rating == 1:  # up
+        return 2.0
+    if rating == 0:  # down
+        return 0.2
+    return 1.0
+
+
+def interaction_weights(ratings: np.ndarray) -> np.ndarray:
+    """Vectorised `interaction_weight()` for an array of ratings."""
+    ratings = np.asarray(ratings)
+    weights = np.ones(len(ratings), dtype=np.float64)
+    weights[ratings == 2] = 3.0
+    weights[ratings == 1] = 2.0
+    weights[ratings == 0] = 0.2
+    return weights
+
+
+def fetch_interaction_embeddings(user_ids, field: str = "embedding"):
+    """
+    Yield `(user_id, ratings, embeddings)` for every given user with at least one embedded interaction.
+
+    `embeddings` is an (n, d) float64 array with a row per interaction, ordered like the
+    `UserViewInteraction` default ordering. All users are read with one query that selects only the rating
+    and the vector column, in pgvector's binary format, which is decoded for all rows with one `np.frombuffer`.
+    """
+    quote = connection.ops.quote_name
+    column = quote(MotnShow._meta.get_field(field).column)
+    sql = f"""
+        SELECT i.user_id, i.rating, vector_send(s.{column})
+        FROM {quote(UserViewInteraction._meta.db_table)} i
+        JOIN {quote(MotnShow._meta.db_table)} s ON s.id = i.show_id
+        WHERE i.user_id = ANY(%s) AND s.{column} IS NOT NULL
+        ORDER BY i.user_id, i.last_date DESC, i.id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [list(user_ids)])
+        rows = cursor.fetchall()
+    if not rows:
+        return
+
+    n = len(rows)
+    owners = np.fromiter((row[0] for row in rows), dtype=np.int64, count=n)
+    ratings = np.fromiter((row[1] for row in rows), dtype=np.int64, count=n)
+    # Each value is a 4 byte header (int16 dimensions, int16 unused) followed by big-endian float4s,
+    # the header takes the place of one float: drop the first column. float32 -> float64 like the ORM path.
+    values = np.frombuffer(b"".join(row[2] for row in rows), dtype=">f4").reshape(n, -1)
+    embeddings = values[:, 1:].astype(np.float64)
+
+    starts = np.flatnonzero(np.diff(owners)) + 1
+    for user_rows in np.split(np.arange(n), starts):
+        yield int(owners[user_rows[0]]), ratings[user_rows], embeddings[user_rows]
+
+
+def rebuild_taste_profile(user_id: int) -> UserTasteProfile:
+    """Recompute the profile from all interactions, e.g. after the show embeddings were rebuilt."""
+    return rebuild_taste_profiles([user_id])[0]
+
+
+def rebuild_taste_profiles(user_ids) -> list[UserTasteProfile]:
+    """`rebuild_taste_profile()` for many users, their interactions are read with one query."""
+    sums = {}
+    for user_id, ratings, embeddings in fetch_interaction_embeddings(user_ids):
+        weights = interaction_weights(ratings)
+        sums[user_id] = (weights @ embeddings, float(weights.sum()), len(weights))
+
+    profiles = []
+    for user_id in user_ids:
+        vector_sum, weight_total, item_count = sums.get(user_id, (None, 0.0, 0))
+        profile, _ = UserTasteProfile.objects.update_or_create(
+            user_id=user_id,
+            defaults={
+                "vector_sum": vector_sum,
+                "weight_total": weight_total,
+                "item_count": item_count,
+                "centroids_stale": True,
+                "updates_since_rebuild": 0,
+            },
+        )
+        profiles.append(profile)
+    return profiles
+
+
+def update_taste_profile(user_id: int, show_id: int, weight_delta: float, count_delta: int, create: bool = True):
+    """
+    Add `weight_delta` times the show's embedding to the user's profile.
+
+    A user without profile gets one built from all interactions when `create` is set (which then already
+    includes the change), otherwise the change is ignored.
+    """
+    embeddings = list(MotnShow.objects.filter(id=show_id).values_list("embedding", flat=True))
+    if not embeddings or embeddings[0] is None:
+        return  # shows without embedding do not count
+
+    with transaction.atomic():
+        profile = UserTasteProfile.objects.select_for_update().filter(user_id=user_id).first()
+        if profile is None:
+            if create:
+                rebuild_taste_profile(user_id)
+            return
+        if profile.updates_since_rebuild + 1 >= settings.TASTE_PROFILE_REBUILD_EVERY:
+            # The interaction is already saved (or deleted), the rebuild includes the change
+            rebuild_taste_profile(user_id)
+            return
+
+        weighted = weight_delta * np.asarray(embeddings[0], dtype=np.float64)
+        if profile.vector_sum is None:
+            profile.vector_sum = weighted
+        else:
+            profile.vector_sum = np.asarray(profile.vector_sum, dtype=np.float64) + weighted
+        profile.weight_total += weight_delta
+        profile.item_count += count_delta
+        profile.centroids_stale = True
+        profile.updates_since_rebuild += 1
+        profile.save(
+            update_fields=[
+                "vector_sum",
+                "weight_total",
+                "item_count",
+                "centroids_stale",
+                "updates_since_rebuild",
+                "updated_at",
+            ]
+        )
+
+
+def get_taste_vector(user_id: int, min_items: int = 3):
+    """The user's normalised taste vector as a list, or None with fewer than `min_items` embedded interactions."""
+    profile = UserTasteProfile.objects.filter(user_id=user_id).first()
+    if profile is None:
+        profile = rebuild_taste_profile(user_id)
+
+    if profile.item_count < min_items or profile.vector_sum is None:
+        return None
+
+    # The weighted average has the same direction as the weighted sum
+    user_vec = np.asarray(profile.vector_sum, dtype=np.float64)
+    norm = np.linalg.norm(user_vec)
+    if norm == 0:
+        return None
+    return (user_vec / norm).tolist()
+
+
+def spherical_kmeans(embeddings: np.ndarray, weights: np.ndarray, k: int, iterations: int = 20, seed: int = 0):
+    """
+    Weighted k-means on the unit sphere (cosine similarity), all steps are matrix products.
+
+    Returns `(centroids, labels)`: the (k', d) normalised centres of the non-empty clusters (k' <= k)
+    and the cluster of every row. Seeded k-means++ initialisation, so the result is deterministic.
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    x = embeddings / norms
+    rng = np.random.default_rng(seed)
+
+    # k-means++: next centre with probability proportional to its weighted distance from the chosen ones
+    centroids = x[[rng.choice(len(x), p=weights / weights.sum())]]
+    while len(centroids) < k:
+        distances = np.clip(1 - np.max(x @ centroids.T, axis=1), 0, None) * weights
+        if distances.sum() == 0:
+            break
+        centroids = np.vstack([centroids, x[rng.choice(len(x), p=distances / distances.sum())]])
+
+    labels = None
+    for _ in range(iterations):
+        new_labels = np.argmax(x @ centroids.T, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        # (k, n) weighted membership matrix, one product gives all cluster sums
+        membership = (labels == np.arange(len(centroids))[:, None]) * weights
+        sums = membership @ x
+        sum_norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their centre
+        centroids = np.where(sum_norms > 0, sums / np.where(sum_norms > 0, sum_norms, 1), centroids)
+
+    used = np.unique(labels)
+    remap = np.full(len(centroids), -1)
+    remap[used] = np.arange(len(used))
+    return centroids[used], remap[labels]
+
+
+def compute_interest_centroids(user_id: int) -> list[tuple[list[float], float]]:
+    """Cluster the user's interactions and store the centroids, returns `(vector, weight)` pairs by weight."""
+    seen = UserTasteProfile.objects.filter(user_id=user_id).values_list("updated_at", flat=True).first()
+
+    rows = [
+        UserInterestCentroid(user_id=user_id, vector=centroid.tolist(), weight=weight, item_count=count)
+        for centroid, weight, count in _cluster_interactions(user_id)
+    ]
+    with transaction.atomic():
+        UserInterestCentroid.objects.filter(user_id=user_id).delete()
+        UserInterestCentroid.objects.bulk_create(rows)
+        # Stays stale when an interaction changed meanwhile
+        UserTasteProfile.objects.filter(user_id=user_id, updated_at=seen).update(centroids_stale=False)
+
+    rows.sort(key=lambda row: -row.weight)
+    return [(row.vector, row.weight) for row in rows]
+
+
+def _cluster_interactions(user_id: int):
+    for _, ratings, embeddings in fetch_interaction_embeddings([user_id]):
+        weights = interaction_weights(ratings)
+        k = min(settings.TASTE_INTEREST_CLUSTERS, len(weights) // settings.TASTE_INTEREST_MIN_ITEMS)
+        if k <= 1:
+            labels = np.zeros(len(weights), dtype=np.int64)
+            centroid = weights @ embeddings
+            centroids = (centroid / (np.linalg.norm(centroid) or 1))[None, :]
+        else:
+            centroids, labels = spherical_kmeans(embeddings, weights, k)
+
+        total = weights.sum()
+        for index, centroid in enumerate(centroids):
+            in_cluster = labels == index
+            yield centroid, float(weights[in_cluster].sum() / total), int(in_cluster.sum())
+
+
+def get_interest_centroids(user_id: int, min_items: int = 3) -> list[tuple[list[float], float]] | None:
+    """
+    The user's interest centroids as `(vector, weight)` pairs, heaviest first.
+
+    Served from `UserInterestCentroid` and only recomputed after the interactions changed.
+    None with fewer than `min_items` embedded interactions, like `get_taste_vector()`.
+    """
+    user_id = getattr(user_id, "pk", user_id)
+    profile = UserTasteProfile.objects.filter(user_id=user_id).first()
+    if profile is None:
+        profile = rebuild_taste_profile(user_id)
+    if profile.item_count < min_items:
+        return None
+
+    if profile.centroids_stale:
+        return compute_interest_centroids(user_id)
+    return [
+        (list(vector), weight)
+        for vector, weight in UserInterestCentroid.objects.filter(user_id=user_id).values_list("vector", "weight")
+    ]
@@ -0,0 +1,581 @@
+import base64
+import json
+import struct
+import tempfile
+import threading
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from openai import AuthenticationError, OpenAI
+from pgvector.django import CosineDistance
+
+from .circuit_breaker import CircuitOpenError
+from .embedding_dispatcher import EmbeddingDispatcher
+from .embedding_jobs import embed_range_with_batch_api, job_name
+from .embedding_scheduler import EmbeddingScheduler, RateLimiter, pack_batches, parse_duration
+from .embedding_store import EmbeddingStore
+from .lexical_search import reciprocal_rank_fusion
+from .models import EmbeddingJobRange, MotnShow
+from .search_backends import NumpySearchBackend, PgvectorSearchBackend, get_search_backend
+from .snapshot import _VectorRows
+from .taste_profile import spherical_kmeans
+from .vector_writer import COPY_HEADER, COPY_TRAILER, copy_data, write_vectors
+
+
+def stand_in_vector(show_id: int) -> np.ndarray:
+    return np.full(settings.OPENAI_EMBEDDING_DIM, show_id / 1000, dtype="<f4")
+
+
+class BatchAPIStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in of the OpenAI files and batches endpoints `embed_range_with_batch_api()` calls.
+
+    A batch is processed when it is created and completes on its first poll. Requests of the shows in
+    `failing_ids` end up in the error file, the others in the output file with a vector of `stand_in_vector()`.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.files, self.batches = {}, {}
+        self.failing_ids = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def add_file(self, content: bytes, purpose: str) -> dict:
+        file = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": 0,
+            "filename": "requests.jsonl",
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[file["id"]] = (file, content)
+        return file
+
+    def create_batch(self, input_file_id: str, endpoint: str, metadata: dict | None) -> dict:
+        output, errors = [], []
+        for line in self.files[input_file_id][1].splitlines():
+            request = json.loads(line)
+            show_id = int(request["custom_id"].split(":")[0])
+            result = {"id": f"req-{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None}
+            if show_id in self.failing_ids:
+                error = {"message": "Invalid input", "type": "invalid_request_error"}
+                result["response"] = {"status_code": 400, "body": {"error": error}}
+                errors.append(result)
+            else:
+                embedding = base64.b64encode(stand_in_vector(show_id).tobytes()).decode()
+                body = {"object": "list", "data": [{"object": "embedding", "index": 0, "embedding": embedding}]}
+                result["response"] = {"status_code": 200, "body": body}
+                output.append(result)
+
+        def result_file(results):
+            if not results:
+                return None
+            return self.add_file(b"".join(json.dumps(result).encode() + b"\n" for result in results), "batch_output")
+
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": "24h",
+            "status": "validating",
+            "created_at": 0,
+            "metadata": metadata,
+            "request_counts": {"completed": len(output), "failed": len(errors), "total": len(output) + len(errors)},
+        }
+        output_file, error_file = result_file(output), result_file(errors)
+        batch["_result"] = {
+            "output_file_id": output_file and output_file["id"],
+            "error_file_id": error_file and error_file["id"],
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        return self.public(batch)
+
+    def poll_batch(self, batch_id: str) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "validating":
+                batch.update(status="completed", **batch["_result"])
+            return self.public(batch)
+
+    @staticmethod
+    def public(batch: dict) -> dict:
+        return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    server: BatchAPIStandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data: dict, status: int = 200):
+        self.send_body(json.dumps(data).encode(), "application/json", status)
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":
+            form = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+            purpose = fields["purpose"].get_content().strip()
+            self.send_json(self.server.add_file(fields["file"].get_payload(decode=True), purpose))
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            self.send_json(
+                self.server.create_batch(request["input_file_id"], request["endpoint"], request.get("metadata"))
+            )
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in self.server.batches:
+            self.send_json(self.server.poll_batch(parts[2]))
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[2] in self.server.files:
+            self.send_body(self.server.files[parts[2]][1], "application/octet-stream")
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+
+class BatchAPIEmbeddingTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stand_in = BatchAPIStandIn()
+        threading.Thread(target=cls.stand_in.serve_forever, daemon=True).start()
+        cls.store_dir = tempfile.TemporaryDirectory()
+        cls.enterClassContext(override_settings(EMBEDDING_STORE_DIR=cls.store_dir.name))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stand_in.shutdown()
+        cls.stand_in.server_close()
+        cls.store_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.stand_in.failing_ids.clear()
+        self.shows = [
+            MotnShow.objects.create(motn_id=f"batch-test-{number}", title=f"Show {number}", overview="A plot.")
+            for number in range(5)
+        ]
+        self.job_range = EmbeddingJobRange.objects.create(
+            job=job_name("openai-batch"), first_id=self.shows[0].id, last_id=self.shows[-1].id
+        )
+        self.client = OpenAI(api_key="test", base_url=self.stand_in.url, max_retries=0)
+
+    def embed(self) -> int:
+        return embed_range_with_batch_api(
+            self.job_range, only_changed=False, page_size=2, client=self.client, poll_interval=0, use_store=False
+        )
+
+    def test_range_is_submitted_polled_and_written(self):
+        failing = self.shows[1]
+        self.stand_in.failing_ids.add(failing.id)
+
+        with self.assertLogs("movies.embedding_jobs", "WARNING") as logs:
+            self.assertEqual(self.embed(), 4)
+
+        self.assertIn(f"1 requests of batch {self.job_range.batch_id} failed (Invalid input)", logs.output[0])
+        self.job_range.refresh_from_db()
+        self.assertEqual(self.job_range.done_id, self.job_range.last_id)
+        self.assertEqual(self.job_range.embedded, 4)
+        self.assertIsNotNone(self.job_range.completed_at)
+        for show in MotnShow.objects.filter(id__in=[show.id for show in self.shows]):
+            if show.id == failing.id:
+                self.assertIsNone(show.embedding)
+                self.assertEqual(show.embedding_hash, "")
+            else:
+                np.testing.assert_array_equal(np.asarray(show.embedding, dtype="<f4"), stand_in_vector(show.id))
+                self.assertEqual(show.embedding_model, settings.OPENAI_EMBEDDING_MODEL)
+                self.assertEqual(len(show.embedding_hash), 64)
+
+    def test_failed_batch_is_submitted_again(self):
+        self.stand_in.failing_ids.update(show.id for show in self.shows)
+
+        with self.assertLogs("movies.embedding_jobs", "WARNING"), self.assertRaisesMessage(RuntimeError, "All 5"):
+            self.embed()
+
+        self.job_range.refresh_from_db()
+        self.assertEqual(self.job_range.batch_id, "")
+        self.assertIsNone(self.job_range.completed_at)
+        self.assertFalse(
+            MotnShow.objects.filter(id__in=[show.id for show in self.shows], embedding__isnull=False).exists()
+        )
+
+
+class _RefusingEmbeddings:
+    """`client.embeddings.with_raw_response` of an AsyncOpenAI client whose key is refused."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        response = SimpleNamespace(status_code=401, headers={}, request=None)
+        raise AuthenticationError("Incorrect API key", response=response, body=None)
+
+
+class EmbeddingSchedulerTest(SimpleTestCase):
+    async def test_refused_request_stops_the_scheduler(self):
+        embeddings = _RefusingEmbeddings()
+        client = SimpleNamespace(embeddings=SimpleNamespace(with_raw_response=embeddings))
+        scheduler = EmbeddingScheduler(model="test", max_items=2, concurrency=2, max_retries=3, client=client)
+
+        async def on_batch(indices, vectors):
+            self.fail("No batch is embedded")
+
+        with self.assertLogs("movies.embedding_scheduler", "ERROR"):
+            done = scheduler.submit(["a text"] * 20, on_batch)
+            with self.assertRaises(AuthenticationError):
+                await done
+        await scheduler.close()
+
+        # No retries and no further batches once the first answer came back
+        self.assertLessEqual(embeddings.calls, 2)
+        self.assertEqual(scheduler.backlog, 0)
+        with self.assertRaises(AuthenticationError):
+            scheduler.submit(["another text"], on_batch)
+
+
+class EmbeddingDispatcherTest(SimpleTestCase):
+    def dispatch(self, error):
+        def embed_many(texts):
+            raise error
+
+        dispatcher = EmbeddingDispatcher(embed_many, max_wait_ms=0)
+        with self.assertRaises(type(error)):
+            dispatcher.embed("a show about dragons")
+
+    def test_open_circuit_is_logged_without_traceback(self):
+        with self.assertLogs("movies.embedding_dispatcher", level="DEBUG") as logs:
+            self.dispatch(CircuitOpenError("Circuit embeddings is open"))
+        self.assertEqual([record.levelname for record in logs.records], ["DEBUG"])
+        self.assertIsNone(logs.records[0].exc_info)
+
+    def test_request_error_is_logged_with_traceback(self):
+        with self.assertLogs("movies.embedding_dispatcher", level="DEBUG") as logs:
+            self.dispatch(RuntimeError("connection reset"))
+        self.assertEqual([record.levelname for record in logs.records], ["WARNING"])
+        self.assertIsNotNone(logs.records[0].exc_info)
+
+
+class SearchBackendParityTest(TestCase):
+    """Both backends return the shows of the exact `CosineDistance` ordering, in every mode they share."""
+
+    modes = ("vector", "matryoshka", "binary")
+    top_k = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.default_rng(0)
+        dim = settings.OPENAI_EMBEDDING_DIM
+        cls.queries = [vector / np.linalg.norm(vector) for vector in rng.standard_normal((2, dim))]
+        # Shows turn from the first query to the second one, far enough apart for halfvec distances to keep the order
+        shows = []
+        for number, angle in enumerate(np.linspace(0, np.pi / 2, 12)):
+            vector = np.cos(angle) * cls.queries[0] + np.sin(angle) * cls.queries[1]
+            vector += rng.standard_normal(dim) * 0.05 / np.sqrt(dim)
+            shows.append(MotnShow(motn_id=f"parity-{number}", title=f"Show {number}", embedding=vector.tolist()))
+        cls.ids = [show.id for show in MotnShow.objects.bulk_create(shows)]
+        cls.other_ids = list(MotnShow.objects.exclude(id__in=cls.ids).values_list("id", flat=True))
+
+    def setUp(self):
+        self.backends = [NumpySearchBackend(refresh_interval=0), PgvectorSearchBackend()]
+
+    def expected(self, query) -> list[tuple[int, float]]:
+        rows = MotnShow.objects.filter(id__in=self.ids).annotate(distance=CosineDistance("embedding", query.tolist()))
+        return list(rows.order_by("distance").values_list("id", "distance")[: self.top_k])
+
+    def assertSameHits(self, hits, expected):
+        self.assertEqual([show_id for show_id, _ in hits], [show_id for show_id, _ in expected])
+        for (_, distance), (_, expected_distance) in zip(hits, expected, strict=True):
+            self.assertAlmostEqual(distance, expected_distance, places=3)
+
+    def test_search_ids(self):
+        queryset = MotnShow.objects.filter(id__in=self.ids)
+        for backend in self.backends:
+            for mode in self.modes:
+                for query in self.queries:
+                    with self.subTest(backend=backend.name, mode=mode):
+                        hits = backend.search_ids(query.tolist(), self.top_k, queryset=queryset, mode=mode)
+                        self.assertSameHits(hits, self.expected(query))
+
+    def test_search_ids_many(self):
+        expected = [self.expected(query) for query in self.queries]
+        for backend in self.backends:
+            for mode in self.modes:
+                with self.subTest(backend=backend.name, mode=mode):
+                    hits = backend.search_ids_many(
+                        [query.tolist() for query in self.queries], self.top_k, exclude_ids=self.other_ids, mode=mode
+                    )
+                    for query_hits, query_expected in zip(hits, expected, strict=True):
+                        self.assertSameHits(query_hits, query_expected)
+
+    def test_local_mode_falls_back_to_pgvector(self):
+        self.assertIsInstance(get_search_backend("numpy", mode="local"), PgvectorSearchBackend)
+        self.assertIsInstance(get_search_backend("numpy", mode="vector"), NumpySearchBackend)
+
+
+class ReciprocalRankFusionTest(SimpleTestCase):
+    def test_shows_in_both_rankings_come_first(self):
+        vector = [(1, 0.1), (2, 0.2), (3, 0.3)]
+        lexical = [(3, 0.9), (1, 0.5)]
+        # 1: 1/61 + 1/62, 3: 1/63 + 1/61, 2: 1/62
+        self.assertEqual(reciprocal_rank_fusion(vector, lexical, k=60), [1, 3, 2])
+
+    def test_only_positions_count(self):
+        self.assertEqual(
+            reciprocal_rank_fusion([(1, 0.0), (2, 100.0)], [(2, -5.0), (1, 0.0)], k=60),
+            reciprocal_rank_fusion([(1, 0.5), (2, 0.6)], [(2, 0.5), (1, 0.6)], k=60),
+        )
+
+    def test_k_weighs_the_top_ranks(self):
+        # Show 1 is first in one ranking, show 2 third in two
+        rankings = ([(1, 0), (6, 0), (7, 0)], [(3, 0), (4, 0), (2, 0)], [(5, 0), (8, 0), (2, 0)])
+        fused = reciprocal_rank_fusion(*rankings, k=0)
+        self.assertLess(fused.index(1), fused.index(2))
+        fused = reciprocal_rank_fusion(*rankings, k=60)
+        self.assertLess(fused.index(2), fused.index(1))
+
+    def test_empty_rankings(self):
+        self.assertEqual(reciprocal_rank_fusion([], [], k=60), [])
+
+
+class SphericalKMeansTest(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        # Two interests along the first and second axis, scaled rows: only the direction counts
+        self.directions = np.eye(16)[:2]
+        self.embeddings = np.vstack(
+            [direction + rng.normal(scale=0.05, size=(10, 16)) for direction in self.directions]
+        ) * rng.uniform(0.5, 3, size=(20, 1))
+        self.weights = np.ones(20)
+
+    def test_clusters_by_direction(self):
+        centroids, labels = spherical_kmeans(self.embeddings, self.weights, k=2)
+
+        self.assertEqual(centroids.shape, (2, 16))
+        np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1)
+        self.assertEqual(len(set(labels[:10])), 1)
+        self.assertEqual(len(set(labels[10:])), 1)
+        self.assertNotEqual(labels[0], labels[10])
+        for label, direction in ((labels[0], self.directions[0]), (labels[10], self.directions[1])):
+            self.assertGreater(centroids[label] @ direction, 0.99)
+
+    def test_same_seed_same_result(self):
+        first = spherical_kmeans(self.embeddings, self.weights, k=3, seed=7)
+        second = spherical_kmeans(self.embeddings, self.weights, k=3, seed=7)
+        np.testing.assert_array_equal(first[0], second[0])
+        np.testing.assert_array_equal(first[1], second[1])
+
+    def test_no_more_clusters_than_distinct_rows(self):
+        embeddings = np.repeat(self.directions, 5, axis=0)
+        centroids, labels = spherical_kmeans(embeddings, np.ones(10), k=4)
+
+        self.assertEqual(len(centroids), 2)
+        self.assertEqual(sorted(set(labels)), [0, 1])
+
+    def test_weights_pull_the_centroid(self):
+        embeddings = np.array([[1.0, 0.0], [0.0, 1.0]])
+        centroids, _ = spherical_kmeans(embeddings, np.array([3.0, 1.0]), k=1)
+        np.testing.assert_allclose(centroids[0], np.array([3.0, 1.0]) / np.sqrt(10))
+
+
+class CopyDataTest(SimpleTestCase):
+    def setUp(self):
+        self.ids = [3, 2**40, 7]
+        self.vectors = np.array([[0.5, -1.25, 3.0], [0.0, 1e-3, -7.5], [1.0, 2.0, 4.0]], dtype=np.float32)
+
+    def test_rows_have_the_vector_recv_layout(self):
+        data = copy_data(self.ids, self.vectors, {"hash": ["a", None, "é"]}).getvalue()
+
+        self.assertTrue(data.startswith(COPY_HEADER))
+        self.assertTrue(data.endswith(COPY_TRAILER))
+        offset = len(COPY_HEADER)
+        for show_id, vector, text in zip(self.ids, self.vectors, [b"a", None, "é".encode()], strict=True):
+            fields, id_size, row_id = struct.unpack_from(">hiq", data, offset)
+            offset += 14
+            self.assertEqual((fields, id_size, row_id), (3, 8, show_id))
+            # Field length, then dimensions and an unused int16 before the big-endian floats
+            size, dim, unused = struct.unpack_from(">ihh", data, offset)
+            offset += 8
+            self.assertEqual((size, dim, unused), (4 + 4 * 3, 3, 0))
+            np.testing.assert_array_equal(np.frombuffer(data, dtype=">f4", count=3, offset=offset), vector)
+            offset += 12
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            if text is None:
+                self.assertEqual(length, -1)
+            else:
+                self.assertEqual(data[offset : offset + length], text)
+                offset += length
+        self.assertEqual(offset + len(COPY_TRAILER), len(data))
+
+    def test_round_trip_through_the_export_reader(self):
+        ids = np.empty(3, dtype=np.int64)
+        values = np.empty((3, 3), dtype=np.float32)
+        rows = _VectorRows(ids, values)
+        data = copy_data(self.ids, self.vectors).getvalue()
+        # COPY TO STDOUT hands over arbitrary chunks
+        for start in range(0, len(data), 5):
+            rows.write(data[start : start + 5])
+
+        self.assertEqual(rows.count, 3)
+        np.testing.assert_array_equal(ids, self.ids)
+        np.testing.assert_array_equal(values, self.vectors)
+
+
+class WriteVectorsTest(TestCase):
+    def test_vectors_and_columns_are_written(self):
+        shows = [MotnShow.objects.create(motn_id=f"write-test-{number}", title=f"Show {number}") for number in range(3)]
+        ids = [show.id for show in shows]
+        vectors = np.arange(3 * settings.LOCAL_EMBEDDING_DIM, dtype=np.float32).reshape(3, -1) / 7
+
+        # Two writes in one transaction, each with its own temporary table
+        self.assertEqual(
+            write_vectors(MotnShow, "embedding_local", ids[:2], vectors[:2], embedding_local_hash=["a", "b"]), 2
+        )
+        self.assertEqual(
+            write_vectors(MotnShow, "embedding_local", ids[2:], vectors[2:], embedding_local_hash=["c"]), 1
+        )
+
+        for show, vector, digest in zip(
+            MotnShow.objects.filter(id__in=ids).order_by("id"), vectors, "abc", strict=True
+        ):
+            np.testing.assert_array_equal(np.asarray(show.embedding_local, dtype=np.float32), vector)
+            self.assertEqual(show.embedding_local_hash, digest)
+            self.assertGreater(show.updated_at, shows[0].updated_at)
+
+    def test_one_value_per_id(self):
+        with self.assertRaises(ValueError):
+            write_vectors(MotnShow, "embedding_local", [1, 2], np.zeros((2, 4)), embedding_local_hash=["a"])
+
+
+class PackBatchesTest(SimpleTestCase):
+    def test_batches_stay_under_both_limits(self):
+        counts = [30, 40, 50, 10, 10, 10, 10, 90]
+        batches = pack_batches(counts, max_tokens=100, max_items=3)
+
+        self.assertEqual([batch.indices for batch in batches], [[0, 1], [2, 3, 4], [5, 6], [7]])
+        self.assertEqual([batch.tokens for batch in batches], [70, 70, 20, 90])
+
+    def test_a_text_over_the_token_limit_gets_its_own_batch(self):
+        batches = pack_batches([10, 500, 10], max_tokens=100, max_items=10)
+        self.assertEqual([batch.indices for batch in batches], [[0], [1], [2]])
+
+    def test_no_texts(self):
+        self.assertEqual(pack_batches([], max_tokens=100, max_items=10), [])
+
+
+class RateLimitHeadersTest(SimpleTestCase):
+    def test_parse_duration(self):
+        for value, seconds in (("20ms", 0.02), ("1s", 1), ("6m0s", 360), ("1h2m3.5s", 3723.5), ("0.5s", 0.5)):
+            with self.subTest(value=value):
+                self.assertAlmostEqual(parse_duration(value), seconds)
+        for value in (None, "", "soon"):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_duration(value))
+
+    def test_limiter_reads_the_remaining_budget(self):
+        limiter = RateLimiter()
+        limiter.update(
+            {
+                "x-ratelimit-remaining-tokens": "1000",
+                "x-ratelimit-reset-tokens": "6m0s",
+                "x-ratelimit-remaining-requests": "4",
+                "x-ratelimit-reset-requests": "20ms",
+            }
+        )
+
+        self.assertEqual((limiter.remaining_tokens, limiter.remaining_requests), (1000, 4))
+        self.assertAlmostEqual(limiter.tokens_reset_at - limiter.requests_reset_at, 360 - 0.02, places=2)
+
+    def test_limited_honours_retry_after(self):
+        limiter = RateLimiter()
+        self.assertGreaterEqual(limiter.limited({"retry-after-ms": "2500"}), 2.5)
+        self.assertGreaterEqual(limiter.limited({"retry-after": "4"}), 4)
+
+
+class EmbeddingStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.digests = [f"{number:064x}" for number in range(6)]
+        self.vectors = np.arange(6 * 4, dtype=np.float32).reshape(6, 4)
+
+    def test_put_and_get(self):
+        store = EmbeddingStore("test-model", root=self.root)
+        self.assertEqual(store.put(self.digests[:4], self.vectors[:4]), 4)
+        # Known and repeated digests are not added again
+        self.assertEqual(store.put(self.digests[2:5] + self.digests[4:5], self.vectors[[2, 3, 4, 4]]), 1)
+
+        found, vectors = store.get([self.digests[5], self.digests[4], self.digests[0]])
+        self.assertEqual(found, [1, 2])
+        np.testing.assert_array_equal(vectors, self.vectors[[4, 0]])
+        self.assertEqual(len(store), 5)
+
+    def test_other_instances_read_the_appended_records(self):
+        reader = EmbeddingStore("test-model", root=self.root)
+        self.assertEqual(reader.get(self.digests)[0], [])
+
+        EmbeddingStore("test-model", root=self.root).put(self.digests[:3], self.vectors[:3])
+        found, vectors = reader.get(self.digests)
+        self.assertEqual(found, [0, 1, 2])
+        np.testing.assert_array_equal(vectors, self.vectors[:3])
+
+    def test_vectors_fill_shards_in_order(self):
+        store = EmbeddingStore("test-model", root=self.root)
+        with mock.patch("movies.embedding_store.SHARD_ROWS", 4):
+            store.put(self.digests[:3], self.vectors[:3])
+            store.put(self.digests[3:], self.vectors[3:])
+
+        self.assertEqual(
+            sorted(path.name for path in store.path.glob("shard-*")), ["shard-00000.f32", "shard-00001.f32"]
+        )
+        np.testing.assert_array_equal(EmbeddingStore("test-model", root=self.root).get(self.digests)[1], self.vectors)
+
+    def test_rows_without_index_records_are_overwritten(self):
+        store = EmbeddingStore("test-model", root=self.root)
+        store.put(self.digests[:2], self.vectors[:2])
+        # A writer that crashed between its vectors and its index records
+        shard = store.path / "shard-00000.f32"
+        with shard.open("ab") as fh:
+            fh.write(np.full((3, 4), -1, dtype="<f4").tobytes())
+
+        EmbeddingStore("test-model", root=self.root).put(self.digests[2:4], self.vectors[2:4])
+
+        self.assertEqual(shard.stat().st_size, 4 * 4 * 4)
+        np.testing.assert_array_equal(
+            EmbeddingStore("test-model", root=self.root).get(self.digests)[1], self.vectors[:4]
+        )
+
+    def test_dimensions_are_fixed_by_the_first_vectors(self):
+        store = EmbeddingStore("test-model", root=self.root)
+        store.put(self.digests[:1], self.vectors[:1])
+        with self.assertRaises(ValueError):
+            store.put(self.digests[1:2], np.zeros((1, 8)))
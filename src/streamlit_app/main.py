@@ -18,6 +18,17 @@ def django_setup():
 
     django.setup()
 
+    # Recomputes recommendations queued by rating changes, also those queued before a restart
+    from movies.recommendation_queue import recommendation_refresher
+
+    recommendation_refresher.start()
+
+    # Load the local query encoder once per process, before the first search instead of during it
+    if settings.SEARCH_MODE == "local":
+        from movies.local_encoder import local_encoder
+
+        local_encoder.warm_up()
+
 
 def main():
     setup_logging()
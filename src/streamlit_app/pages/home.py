@@ -13,12 +13,6 @@ def main_page():
     from misc.utils.version import get_app_version
     load_css()
 
-    # Handle deferred recommendation updates (e.g. from Netflix page)
-    if st.session_state.get("recommendations_need_update") and st.session_state.get("user"):
-        from movies.search import update_user_recommendations
-        update_user_recommendations(st.session_state["user"])
-        st.session_state["recommendations_need_update"] = False
-
     # --- Header Section ---
     st.markdown("""
         <div class="title-container">
@@ -85,8 +79,13 @@ def main_page():
             with st.spinner("Analyzing semantic matches..."):
                 from movies.search import search_shows
                 user_id = st.session_state["user"].id if st.session_state.get("user") else None
-                # Always fetch 200 results
-                results, structured = search_shows(query.strip(), top_k=200, user=user_id)
+                # Always fetch 200 results, as compact display-only objects
+                stats = {}
+                results, structured = search_shows(
+                    query.strip(), top_k=200, user=user_id, projection=True, stats=stats
+                )
+                if stats["degraded"]:
+                    st.info("Search is slower than usual right now, these results may be less accurate.")
                 # Store results in session state to persist across reruns
                 st.session_state.search_results = list(results)
                 # Reset visible count to the user's selected top_k
@@ -96,12 +95,12 @@ def main_page():
 
     # If no active search results, check if we can populate with user recommendations
     if not st.session_state.search_results and not query.strip() and st.session_state.get("user"):
-        from movies.models import UserRecommendation, MotnShow
+        from movies.models import UserRecommendation
+        from movies.search_backends import fetch_shows
         rec = UserRecommendation.objects.filter(user=st.session_state["user"]).first()
         if rec and rec.recommended_shows:
              ids = rec.recommended_shows
-             shows_map = {s.id: s for s in MotnShow.objects.filter(id__in=ids)}
-             results_list = [shows_map[i] for i in ids if i in shows_map]
+             results_list = fetch_shows([(i, None) for i in ids], projection=True)
              st.session_state.search_results = results_list
              st.session_state.visible_count = top_k
 
@@ -130,10 +129,10 @@ def main_page():
                 col1, col2 = st.columns([1, 4])
                 
                 with col1:
-                    if show.poster_urls and "w240" in show.poster_urls:
+                    if show.poster_url:
                         # Use HTML img to avoid enlargement and add margin for alignment
                         st.markdown(
-                            f'<img src="{show.poster_urls["w240"]}" style="width: 100%; border-radius: 8px; margin-top: 10px;">', 
+                            f'<img src="{show.poster_url}" style="width: 100%; border-radius: 8px; margin-top: 10px;">', 
                             unsafe_allow_html=True
                         )
                     else:
@@ -163,12 +162,8 @@ def main_page():
                     st.write(show.overview)
 
                     # Watch Link
-                    try:
-                        if show.streaming_options and "nl" in show.streaming_options and show.streaming_options["nl"]:
-                            link = show.streaming_options["nl"][0]["videoLink"]
-                            st.link_button("▶️ Watch on Netflix", link, type="secondary")
-                    except (KeyError, IndexError, TypeError):
-                        pass
+                    if show.watch_link:
+                        st.link_button("▶️ Watch on Netflix", show.watch_link, type="secondary")
                 
                 st.markdown("---")
         
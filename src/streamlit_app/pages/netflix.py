@@ -10,7 +10,7 @@ import streamlit as st
 
 def parse_netflix_csv(file) -> int:
     from movies.models import MotnShow, UserViewInteraction
-    from movies.search import update_user_recommendations
+    from movies.recommendation_queue import recommendation_refresher
     """
     Parses a Netflix viewing activity CSV and creates/updates UserViewInteractions.
     Returns the number of new interactions created.
@@ -102,17 +102,16 @@ def parse_netflix_csv(file) -> int:
             if changed:
                 interaction.save()
 
-    # Recalculate recommendations
+    # Recalculate recommendations in the background
     if new_interactions_count > 0 or len(shows_data) > 0:
-        with st.spinner("Updating recommendations..."):
-            update_user_recommendations(user)
+        recommendation_refresher.request(user.pk)
 
     return new_interactions_count
 
 
 def update_rating(interaction_id):
     from movies.models import UserViewInteraction
-    from movies.search import update_user_recommendations
+    from movies.recommendation_queue import recommendation_refresher
     key = f"up_{interaction_id}"
     val = st.session_state.get(key)
     
@@ -124,10 +123,13 @@ def update_rating(interaction_id):
     else:
         new_rating = 0
         
-    UserViewInteraction.objects.filter(id=interaction_id).update(rating=new_rating)
-    
-    # Defer feedback update to page transition
-    st.session_state["recommendations_need_update"] = True
+    # save() instead of QuerySet.update(), so the signal keeps the user's taste profile up to date
+    interaction = UserViewInteraction.objects.filter(id=interaction_id).first()
+    if interaction is not None and interaction.rating != new_rating:
+        interaction.rating = new_rating
+        interaction.save(update_fields=["rating"])
+        # Debounced, a burst of ratings is recomputed once in the background
+        recommendation_refresher.request(interaction.user_id)
 
 
 def render_user_interactions():